@@ -1,4 +1,4 @@
-from src import conf, handler
+from src import conf, handler, os_ops
 
 logger = conf.logging.getLogger(__name__)
 
@@ -8,19 +8,26 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description = 'Example use of {}\n'.format(__file__.split("\\")[-1]))
     parser.add_argument('filename',
-                        help='File to load from [.csv]\n')
+                        help='File to load from [.csv, .gz, .zip, .xz]\n')
     parser.add_argument('-s', '--SOURCE', type=int, metavar='vessel_number',
                         required=True, help='Numbering of vessel\'s from which to read data from')
     parser.add_argument('-d','--DATA', nargs='+', metavar='variable',
                         help=f'List of variables to build graphs on.\n'+\
                             f'Not selecting variables means choosing all.\n')
+    parser.add_argument('-c', '--COMPACT', action='store_true',
+                        help='Load data with compact dtypes (float32, bool)')
+    parser.add_argument('-f', '--FULL', action='store_true',
+                        help='Plot every sample without decimation')
     
     args = parser.parse_args()
 
-    if '.csv' not in args.filename:
+    if '.csv' not in args.filename and not os_ops.is_compressed(args.filename):
         parser.error('File not csv')
 
-    handler = handler.Handler(args.filename)
+    handler = handler.Handler(args.filename, compact=args.COMPACT)
+    if args.FULL: handler.add_option('decimate', False)
+    # Save full resolution image only.
+    handler.add_option('preview', False)
     # Check for correct loading.
     if conf._ERROR_HEADER_ in handler.content:
         parser.error(f'{handler.content[conf._ERROR_HEADER_]}')
@@ -47,4 +54,7 @@ if __name__ == '__main__':
     # Filtered selected variables.
     mapping = handler.filter_cols(handler.sources[args.SOURCE-1], data)
     # Make graph and return image filename.
-    print(f'Graph generated as {handler.make_graph(handler.sources[args.SOURCE-1], mapping)}')
\ No newline at end of file
+    print(f'Graph generated as {handler.make_graph(handler.sources[args.SOURCE-1], mapping)}')
+    # Print memory saved by compact dtypes.
+    for source, saved in handler.memory_saved.items():
+        print(f'Compact mode saved {saved/1024:.1f} KiB on {source}')
\ No newline at end of file
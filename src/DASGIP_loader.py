@@ -1,8 +1,14 @@
 import re
 import io
+import os
+import mmap
+import functools
+import numpy as np
 import pandas as pd
-from typing import Optional
-from src import conf, protocols
+from collections.abc import Mapping
+from typing import (IO, Callable, Dict, Iterator, List, NamedTuple, Optional,
+                    Tuple, Union)
+from src import conf, metrics, os_ops, protocols
 
 logger = conf.logging.getLogger(__name__)
 
@@ -14,20 +20,86 @@ _mock_content_ = {"Vessel 1":"Unit.InoculationX [];Unit.Y1.PV [kW]\n00:00:00;0.0
 # to be used as DataFrame columns.                                             #
 ################################################################################
 
+# Precompiled header tags and units matching.
+_TAGS_RE_ = re.compile('|'.join(map(re.escape, conf._HEADER_TAGS_)))
+_UNITS_RE_ = re.compile(r"\[(.*?)\]")
+
+class HeaderEntry(NamedTuple):
+    '''
+       Selected header of a data block.
+    '''
+
+    raw: str
+    clean: str
+    unit: str
+    position: int
+
+class BlockContent(Mapping):
+    '''
+       Read only mapping of vessel names to data blocks of a buffer.
+
+       Keeps the raw buffer (bytes or mmap) and the offsets of each block.
+       Blocks are only decoded when requested.
+    '''
+
+    def __init__(self, buffer: Union[bytes, mmap.mmap],
+                 index: List[Tuple[str, int, int]]) -> None:
+        self.buffer = buffer
+        self.index = {vessel: (start, end) for vessel, start, end in index}
+
+    def __getitem__(self, vessel: str) -> str:
+        start, end = self.index[vessel]
+        # Decode only the block and remove \r if inserted.
+        return self.buffer[start:end].decode('utf-8').replace('\r', '')
+
+    def header(self, vessel: str) -> str:
+        '''
+           Returns first line of a block decoding only that line.
+        '''
+
+        start, end = self.index[vessel]
+        line_end = self.buffer.find(b'\n', start, end)
+        line_end = end if line_end == -1 else line_end
+        return self.buffer[start:line_end].decode('utf-8').replace('\r', '')
+
+    def size(self, vessel: str) -> int:
+        '''
+           Returns size in bytes of a block.
+        '''
+
+        start, end = self.index[vessel]
+        return end - start
+
+    def __contains__(self, vessel: object) -> bool:
+        return vessel in self.index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.index)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
 def file_loader(filename: Optional[str] = None) -> protocols.DATA_TYPE:
     '''
        Load file content as data blocks.
 
        A data block is a dictionay with _TOKEN_
        as key and content as value.
+       File is memory mapped and blocks are decoded on access.
     '''
 
     if filename is None:
         return _mock_content_
 
+    if os_ops.is_compressed(filename):
+        return compressed_file_loader(filename)
+
     try:
-        with open(filename) as f:
-            content = f.read()
+        with open(filename, 'rb') as f:
+            # Map file to memory. mmap does not accept empty files.
+            size = os.fstat(f.fileno()).st_size
+            content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                      if size else b''
     except:
         # Return error messege if unable to load file.
         logger.error(conf._ERROR_FILE_)
@@ -35,39 +107,171 @@ def file_loader(filename: Optional[str] = None) -> protocols.DATA_TYPE:
 
     return data_block_loader(content)
 
-def data_block_loader(content: Optional[str] = None) -> protocols.DATA_TYPE:
+def compressed_file_loader(filename: str) -> protocols.DATA_TYPE:
     '''
-       Breaks a string content as blocks separated by special tokens.
+       Load content of a compressed file as data blocks.
+
+       Content is decompressed as a stream. Only the first csv file
+       of a zip file is loaded.
     '''
 
-    if content is None:
-        return _mock_content_
-    
-    # Get all data blocks.
-    data_blocks = {}
+    try:
+        with open(filename, 'rb') as f:
+            for name, stream in os_ops.open_archive(f, filename):
+                logger.info(f'Loading {name} from {filename}')
+                return stream_block_loader(stream)
+    except:
+        # Return error messege if unable to load file.
+        logger.error(conf._ERROR_FILE_)
+        return {conf._ERROR_HEADER_: conf._ERROR_FILE_}
+    # Return error messege if no csv file in archive.
+    logger.error(conf._ERROR_FILE_)
+    return {conf._ERROR_HEADER_: conf._ERROR_FILE_}
+
+def iter_blocks(stream: IO[bytes],
+                chunk_size: int = conf._CHUNK_SIZE_) -> Iterator[Tuple[str, str]]:
+    '''
+       Yields vessel and data block from a binary stream as soon as
+       each block is complete.
+    '''
+
+    parts = []
+    for vessel, part, complete in iter_block_parts(stream, chunk_size):
+        parts.append(part)
+        if complete:
+            yield vessel, b''.join(parts).decode('utf-8')
+            parts = []
+
+def iter_block_parts(stream: IO[bytes],
+                     chunk_size: int = conf._CHUNK_SIZE_
+                     ) -> Iterator[Tuple[str, bytes, bool]]:
+    '''
+       Yields vessel, part of its data block and if the block is complete,
+       from a binary stream, so no block is kept whole in memory.
+
+       Stream is read in chunks with carriage returns removed. Tokens
+       split between chunks are found by keeping the tail of the
+       previous chunk. Parts of a block without end are yielded, but
+       the block is never complete.
+    '''
+
+    end_token = conf._END_TOKEN_.encode()
+    i = 1
+    token = conf._TOKEN_.format(i).encode()
+    # Unprocessed bytes.
+    buffer = b''
+    inside = False
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        buffer += chunk.replace(b'\r', b'')
+        while(True):
+            if not inside:
+                # Get index of TOKEN.
+                index = buffer.find(token)
+                if index == -1:
+                    # Keep what may be the start of the token.
+                    buffer = buffer[-len(token)+1:]
+                    break
+                buffer = buffer[index+len(token):]
+                inside = True
+            else:
+                # Find end of data block.
+                index = buffer.find(end_token)
+                if index == -1:
+                    # Keep what may be the start of the end token.
+                    keep = max(len(buffer) - len(end_token) + 1, 0)
+                    if keep: yield f'Vessel {i}', buffer[:keep], False
+                    buffer = buffer[keep:]
+                    break
+                yield f'Vessel {i}', buffer[:index], True
+                buffer = buffer[index:]
+                inside = False
+                i += 1
+                token = conf._TOKEN_.format(i).encode()
+
+def stream_block_loader(stream: IO[bytes],
+                        chunk_size: int = conf._CHUNK_SIZE_
+                        ) -> protocols.DATA_TYPE:
+    '''
+       Breaks a binary stream as blocks separated by special tokens.
+    '''
+
+    with metrics.stage('data_block_loader') as record:
+        data_blocks = dict(iter_blocks(stream, chunk_size))
+        record['bytes'] = sum(map(len, data_blocks.values()))
+
+    # Return error messege if no token found.
+    if data_blocks == {}:
+        logger.info(conf._ERROR_NO_TOKEN_)
+        return {conf._ERROR_HEADER_: conf._ERROR_NO_TOKEN_}
+
+    return data_blocks
+
+def _tokens(buffer: Union[str, bytes, mmap.mmap]) -> Tuple[Callable, str]:
+    '''
+       Returns block token builder and end token matching buffer type
+       and line ending.
+    '''
+
+    if isinstance(buffer, str):
+        return conf._TOKEN_.format, conf._END_TOKEN_
+    # Bytes keep \r if inserted.
+    end = buffer.find(b'\n')
+    newline = b'\r\n' if end > 0 and buffer[end-1:end] == b'\r' else b'\n'
+    return (lambda i: conf._TOKEN_.format(i).encode().replace(b'\n', newline),
+            conf._END_TOKEN_.encode().replace(b'\n', newline))
+
+def block_index(buffer: Union[str, bytes, mmap.mmap]
+                ) -> List[Tuple[str, int, int]]:
+    '''
+       Returns (vessel, start, end) offsets of data blocks in buffer.
+
+       Nothing is copied or decoded.
+    '''
+
+    token, end_token = _tokens(buffer)
+    index = []
     i=1
     end_index = 0
     while(True):
         # Get index of TOKEN.
-        start_index = content.find(conf._TOKEN_.format(i), end_index)
+        start_index = buffer.find(token(i), end_index)
         # Break if not found.
         if start_index == -1:
             break
         # Get index after TOKEN.
-        start_index += len(conf._TOKEN_.format(i))
+        start_index += len(token(i))
         # Find end of data block.
-        end_index = content.find(conf._END_TOKEN_, start_index)
+        end_index = buffer.find(end_token, start_index)
         # Include block only if end token found.
         if end_index != -1:
-            data_blocks[f'Vessel {i}'] = content[start_index:end_index]
+            index.append((f'Vessel {i}', start_index, end_index))
         i += 1
 
+    return index
+
+def data_block_loader(content: Optional[Union[str, bytes, mmap.mmap]] = None
+                      ) -> protocols.DATA_TYPE:
+    '''
+       Breaks a string content as blocks separated by special tokens.
+
+       Bytes content is indexed without copies and decoded lazily.
+    '''
+
+    if content is None:
+        return _mock_content_
+
+    # Get all data blocks.
+    with metrics.stage('data_block_loader', bytes=len(content)):
+        index = block_index(content)
+
     # Return error messege if no token found.
-    if data_blocks == {}:
+    if index == []:
         logger.info(conf._ERROR_NO_TOKEN_)
         return {conf._ERROR_HEADER_: conf._ERROR_NO_TOKEN_}
-    
-    return data_blocks
+
+    if isinstance(content, str):
+        return {vessel: content[start:end] for vessel, start, end in index}
+    return BlockContent(content, index)
 
 def clean_header(header: str) -> str:
     '''
@@ -77,23 +281,78 @@ def clean_header(header: str) -> str:
     # without loose brackets and digits/white space at the end.
     return header.split('.')[1].replace('[]','')[:-1]
 
+def first_line(data_block: str) -> str:
+    '''
+       Returns first line of a data block.
+    '''
+
+    end = data_block.find('\n')
+    return data_block[:end if end != -1 else None]
+
+def get_headers(data_block: str) -> List[str]:
+    '''
+       Returns all headers of a data block.
+    '''
+
+    # Get first line as headers. Remove additional double quotes.
+    return first_line(data_block).replace('\"','').split(';')
+
 def header_filter(header: str) -> bool:
     '''
        Checks if header in choice criteria.
     '''
     
-    return len(set(filter(lambda x: x in header, conf._HEADER_TAGS_)))
+    return _TAGS_RE_.search(header) is not None
+
+def get_unit(header: str) -> str:
+    '''
+       Returns unit inside brackets in header.
+    '''
+
+    # Finds units inside brackets in header or None.
+    x = _UNITS_RE_.search(header)
+    x = x and x.group(1)
+    # Time headers have empty brackets or no brackets.
+    return 'h' if x in ('', None) else x
+
+@functools.lru_cache(maxsize=conf._HEADER_CACHE_SIZE_)
+def _header_catalog(header_line: str) -> Tuple[HeaderEntry, ...]:
+    '''
+       Builds catalog of selected headers from a header line.
+    '''
+
+    # Catalogs are memoized: only builds are recorded.
+    with metrics.stage('header_catalog') as record:
+        selected = [(position, head) for position, head
+                    in enumerate(get_headers(header_line))
+                    if header_filter(head)]
+        catalog = tuple(HeaderEntry(head, clean_header(head), get_unit(head),
+                                    position)
+                        for position, head in selected)
+        record.update(bytes=len(header_line), columns=len(catalog))
+    return catalog
+
+def header_catalog(content: protocols.DATA_TYPE,
+                   source: str) -> Tuple[HeaderEntry, ...]:
+    '''
+       Returns catalog of selected headers of a source in content.
+
+       Catalogs are memoized by header line. Only the header line
+       of the block is decoded when content is lazy or compressed.
+    '''
+
+    if hasattr(content, 'header'):
+        return _header_catalog(content.header(source))
+    return _header_catalog(first_line(content[source]))
 
 def header_loader(data_block: str) -> protocols.DATA_TYPE:
     '''
        Builds map of selected headers to cleaner versions.
     '''
 
-    # Get first line as headers. Remove additional double quotes.
-    headers = data_block[:data_block.find('\n')].replace('\"','').split(';')
     # Make pretty headers selected headers. 
-    header_map = {head:clean_header(head) for head in headers \
-                  if header_filter(head)}
+    header_map = {entry.raw: entry.clean for entry in
+                  _header_catalog(first_line(data_block))}
     
     # Check for minimum headers.
     if len(header_map)<2:
@@ -109,52 +368,163 @@ def get_units(header_mapping: protocols.DATA_TYPE) -> protocols.DATA_TYPE:
     '''
     
     logger.info('Building units mapping.')
-    units_mapping = {}
-    for dirty, clean in header_mapping.items():
-        # Finds units inside brackets in header or None.
-        x = re.search(r"\[(.*?)\]", dirty) and \
-            re.search(r"\[(.*?)\]", dirty).group(1)
-        # Time headers have empty brackets or no brackets.
-        units_mapping[clean] = 'h' if x in ('', None) else x
+    units_mapping = {clean: get_unit(dirty)
+                     for dirty, clean in header_mapping.items()}
     logger.info(f'{units_mapping = }')
     return units_mapping
 
-def dataframe_loader(data_block: str,
-                     headers_map: Optional[protocols.DATA_TYPE] = None
-                     ) -> pd.DataFrame:
+def dataframe_loader(data_block: Union[str, IO[str]],
+                     headers_map: Optional[protocols.DATA_TYPE] = None,
+                     size: Optional[int] = None) -> pd.DataFrame:
     '''
-       Load DataFrame from data block.
+       Load DataFrame from data block or text stream of a data block.
 
        Considers first column to be time.
+       Size in bytes of a stream, as stored, is recorded if given.
     '''
 
-    # Load data frame with selected columns or all if no mapping provided.
-    cols = headers_map and headers_map.keys()
-    df = pd.read_csv(io.StringIO(data_block), sep=';', usecols=cols)
-    # Rename if mapping available.
-    if headers_map is not None: df.rename(columns=headers_map, inplace=True)
+    stream = io.StringIO(data_block) if isinstance(data_block, str) \
+             else data_block
+    if size is None:
+        size = len(data_block) if isinstance(data_block, str) else 0
+    with metrics.stage('dataframe_loader', bytes=size) as record, stream:
+        # Load data frame with selected columns or all if no mapping provided.
+        cols = headers_map and headers_map.keys()
+        df = pd.read_csv(stream, sep=';', usecols=cols)
+        # Rename if mapping available.
+        if headers_map is not None: df.rename(columns=headers_map, inplace=True)
+        df = clean_dataframe(df)
+        record.update(rows=len(df), columns=len(df.columns))
+
+    return df
 
+def clean_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+       Clean raw DataFrame loaded from a data block.
+
+       Considers first column to be time. All operations are columnar.
+       Other columns are cast to float. Values that are not numbers, as
+       error tokens, are missing.
+    '''
+
+    time = df.columns[0]
     # With first columns as reference remove, lines prior to first valid value.
-    df.drop(range(df[df.columns[0]].first_valid_index()), inplace=True)
-    df.reset_index(drop=True, inplace=True)
+    df = df.iloc[df[time].first_valid_index():].reset_index(drop=True)
 
     # Convert time to hours transcurred. First column must be time.
-    df[df.columns[0]] = pd.to_datetime(df[df.columns[0]])
-    df[df.columns[0]] = df[df.columns[0]].apply(lambda x: (x-df[df.columns[0]][0]).total_seconds()/3600)
+    # Format is inferred from the first valid value if not set.
+    stamps = pd.to_datetime(df[time], format=conf._DATE_FORMAT_)
+    df[time] = (stamps - stamps.iloc[0]).dt.total_seconds()/3600
+
+    # Types do not depend on other blocks parsed in the same pass.
+    for column in df.columns[1:]:
+        if df[column].dtype != np.float64:
+            df[column] = pd.to_numeric(df[column], errors='coerce'
+                                       ).astype(np.float64)
 
     # Sets all NaN values on a Pandas DataFrame column
     # to the last previous valid value in the column.
-    for column in df.columns:
-        prev_value = None
-        for i in range(len(df)):
-            if pd.isna(df.at[i,column]):
-                df.at[i,column] = prev_value
-            else:
-                prev_value = df.at[i,column]
+    df = df.ffill()
 
     # Ignore remaining leading NaN.
     return df
 
+def compact_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+       Returns DataFrame with compact dtypes.
+
+       Time is kept as float32 hours. Inoculation markers holding only
+       0 and 1 become bool. Other columns become float32 when the error
+       is within _COMPACT_TOLERANCE_ of the column range.
+    '''
+
+    time = df.columns[0]
+    columns = {time: df[time].astype(np.float32)}
+    for column in df.columns[1:]:
+        values = df[column]
+        if conf._MARKER_TAG_ in column and values.isin((0, 1)).all():
+            columns[column] = values.astype(bool)
+            continue
+        if not pd.api.types.is_float_dtype(values) or values.isna().all():
+            columns[column] = values
+            continue
+        compact = values.astype(np.float32)
+        error = (compact.astype(np.float64) - values).abs().max()
+        tolerance = conf._COMPACT_TOLERANCE_ * (values.max() - values.min())
+        columns[column] = compact if error <= tolerance else values
+    return pd.DataFrame(columns)
+
+def dataframes_loader(content: protocols.DATA_TYPE,
+                      headers_maps: Dict[str, protocols.DATA_TYPE]
+                      ) -> Dict[str, pd.DataFrame]:
+    '''
+       Load DataFrames from several data blocks of a file in one pass
+       and record bytes, rows and columns loaded.
+    '''
+
+    size = sum(content.size(source) if hasattr(content, 'size')
+               else len(content[source]) for source in headers_maps)
+    with metrics.stage('dataframes_loader', bytes=size) as record:
+        dfs = _dataframes_loader(content, headers_maps)
+        record.update(rows=sum(len(df) for df in dfs.values()),
+                      columns=sum(len(df.columns) for df in dfs.values()))
+    return dfs
+
+def _dataframes_loader(content: protocols.DATA_TYPE,
+                       headers_maps: Dict[str, protocols.DATA_TYPE]
+                       ) -> Dict[str, pd.DataFrame]:
+    '''
+       Load DataFrames from several data blocks of a file in one pass.
+
+       ```headers_maps``` maps each source to its headers mapping.
+       Blocks with selected columns at the same positions are tokenized
+       together by a single parser call, split by row ranges and named per
+       block, as clean names may hold the vessel number. Other blocks are
+       loaded one by one, streamed to the parser if content can open them.
+    '''
+
+    # Selected columns positions and clean names for each source.
+    layouts, names = {}, {}
+    for source, headers_map in headers_maps.items():
+        entries = [entry for entry in header_catalog(content, source)
+                   if entry.raw in headers_map]
+        layouts[source] = tuple(entry.position for entry in entries)
+        names[source] = [entry.clean for entry in entries]
+
+    # Sources to tokenize together share the most common layout.
+    shared = max(layouts.values(), key=list(layouts.values()).count, default=())
+    batch = [source for source in layouts if layouts[source] == shared]
+    # Blocks missing selected headers or alone are loaded one by one.
+    if len(batch) < 2 or len(shared) < len(headers_maps[batch[0]]):
+        batch = []
+    dfs = {source: dataframe_loader(content.open(source)
+                                    if hasattr(content, 'open')
+                                    else content[source], headers_maps[source],
+                                    content.size(source)
+                                    if hasattr(content, 'size') else None)
+           for source in layouts if source not in batch}
+    if batch == []:
+        return dfs
+
+    # Join data lines of all blocks, counting rows of each block.
+    lines, rows = [], []
+    for source in batch:
+        block = content[source]
+        start = block.find('\n') + 1
+        data = block[start:] if start else ''
+        rows.append(data.count('\n') + 1 if data else 0)
+        if data: lines.append(data)
+    df = pd.read_csv(io.StringIO('\n'.join(lines)), sep=';', header=None,
+                     usecols=shared)
+
+    # Split by row ranges. Slices share the parsed buffers until cleaned.
+    end = 0
+    for source, n in zip(batch, rows):
+        start, end = end, end + n
+        dfs[source] = clean_dataframe(df.iloc[start:end].set_axis(
+            names[source], axis=1).reset_index(drop=True))
+    return {source: dfs[source] for source in headers_maps}
+
 
 if __name__ == '__main__':
 
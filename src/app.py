@@ -1,19 +1,60 @@
+import time
+import threading
+import multiprocessing
+from typing import IO
 from flask import Flask, render_template, request, send_file, redirect, make_response, jsonify, send_from_directory
 from flask_dropzone import Dropzone
-from src import DASGIP_loader, conf, handler, simple_json_db
+from src import DASGIP_loader, column_store, conf, config_store, handler, metrics, os_ops, render_cache, simple_json_db, sqlite_db
+from src.graph_maker import wait_full
+
+logger = conf.logging.getLogger(__name__)
     
-DB = simple_json_db.SimpleJSONDB()
+DB = sqlite_db.SQLiteDB() if conf._DB_BACKEND_ == 'sqlite' \
+     else simple_json_db.SimpleJSONDB()
+# Graph configuration. Taken from the database on first run.
+CONFIG = config_store.ConfigStore(initial=DB.config)
+# Typed columns of stored files.
+STORE = column_store.ColumnStore()
+# Rendered images by content, headers and options.
+CACHE = render_cache.RenderCache()
+
+def sweep() -> None:
+    '''
+       Remove expired data, columns and images, then least recently used
+       data and images over their size limits, every _SWEEP_INTERVAL_
+       seconds.
+    '''
+
+    while True:
+        try:
+            with metrics.stage('sweep'):
+                os_ops.IMAGES.refresh()
+                DB.expire()
+                DB.evict(conf._DATA_MAX_BYTES_)
+                DB.commit()
+                STORE.check_del(DB.get_hashes())
+                os_ops.check_imag_size(conf._IMG_MAX_BYTES_)
+                os_ops.IMAGES.save()
+        except Exception as e:
+            logger.error(f'Unable to sweep data and images: {e}')
+        time.sleep(conf._SWEEP_INTERVAL_)
+
+# Requests and startup do not wait for stored data and images to be scanned.
+# Render workers import this module as main: only the server sweeps.
+if multiprocessing.parent_process() is None:
+    threading.Thread(target=sweep, daemon=True).start()
     
 PAGE_TITLE = "Eppendorf DASGIP Graph Builder"
 _DRAG_DROP_TEXT_ = "(or) Drag and Drop files here."
-_VALID_TYPES_ = ['jpeg', 'png', 'jpg', 'gif']
+_VALID_TYPES_ = ['jpeg', 'png', 'jpg', 'gif', 'webp']
 _VAR_COLS_ = 3
 
 app = Flask(__name__)
 dropzone = Dropzone(app)
 
 def get_handler(filename: str):
-    return handler.Handler(DB.get_content(filename), filename=filename)
+    return handler.Handler(DB.get_content(filename), filename=filename,
+                           store=STORE, cache=CACHE)
 
 @app.route("/")
 def index():
@@ -38,7 +79,7 @@ def index():
                   for j in range(len(vars)//_VAR_COLS_ +1)]
         
         # Clear config from nulls
-        config = DB.config.copy()
+        config = CONFIG.config.copy()
         for key in ('min_map', 'max_map'):
             config[key] = {k:v for k,v in config.get(key, {'': None}).items()
                            if v is not None}
@@ -55,7 +96,7 @@ def index():
 @app.get("/"+conf.API_CONFIG)
 def show_config():
     # Check persistant configuration.
-    return jsonify(DB.config)
+    return jsonify(CONFIG.config)
 
 @app.route("/"+conf.API_CONFIG, methods=["POST", "OPTIONS"])
 def set_config():
@@ -81,9 +122,8 @@ def set_config():
             "max_map":max_map,
             "cols": cols
             }
-        # Update persistant configuration
-        DB.config = options
-        DB.commit()
+        # Update persistant configuration. Written once a burst ends.
+        CONFIG.config = options
     response = make_response("ok")
     response.headers.add('Access-Control-Allow-Origin', "*")
     return response
@@ -103,55 +143,142 @@ def upload():
     '''
 
     for file in request.files.getlist('file'):
-        filename = ''.join( (c for c in file.filename.split('\\')[-1] \
-                             if c.isalnum() or c in ' -_.'))
-        # Decode content, remove \r if inserted and break into blocks per vessel
-        data_blocks = DASGIP_loader.data_block_loader(
-            content=file.read().decode("utf-8").replace("\r",''))
-        # Update database with data blocks for each file
-        DB.update_content(filename, data_blocks)
+        if os_ops.is_compressed(file.filename):
+            # Decompress as a stream into blocks per vessel.
+            # Zip files hold one or more files.
+            try:
+                for name, stream in os_ops.open_archive(file.stream,
+                                                        file.filename):
+                    _store_stream(name, stream)
+            except Exception as e:
+                logger.error(f'Unable to open {file.filename}: {e}')
+        else:
+            _store_stream(file.filename, file.stream)
     
     DB.commit()
     return redirect("/", 302)
 
+def _store_stream(name: str, stream: IO[bytes]) -> None:
+    '''
+       Stores data blocks of an uploaded file under a sanitized filename.
+
+       Upload is read in chunks, without \r, and each block is stored as
+       soon as it is complete.
+    '''
+
+    filename = ''.join( (c for c in name.replace('\\', '/').split('/')[-1] \
+                         if c.isalnum() or c in ' -_.'))
+    # Update database with data blocks for each file.
+    # Blocks already stored under any filename are only referenced.
+    # A failed upload is rolled back, keeping previous content.
+    try:
+        with metrics.stage('ingest') as record:
+            sizes = DB.store_parts(filename,
+                                   DASGIP_loader.iter_block_parts(stream))
+            record['bytes'] = sum(sizes.values())
+    except Exception as e:
+        logger.error(f'Unable to store {filename}: {e}')
+        return
+    # Store error messege if no token found.
+    if sizes == {}:
+        logger.info(conf._ERROR_NO_TOKEN_)
+        DB.update_content(filename,
+                          {conf._ERROR_HEADER_: conf._ERROR_NO_TOKEN_})
+        return
+    # Build header catalogs and typed columns once at upload.
+    # Columns are kept by content hash, so known blocks are not parsed.
+    try:
+        handler.Handler(DB.get_content(filename), filename=filename,
+                        store=STORE).store_sources()
+    except Exception as e:
+        logger.error(f'Unable to store columns of {filename}: {e}')
+
 @app.route("/"+conf.API_GRAPH, methods=["POST", "OPTIONS"])
 def graph_maker():
     if request.method == "OPTIONS":
         response = options_response()
     else:
-        options = DB.config.copy()
+        options = CONFIG.config.copy()
         cols = options.pop("cols")
         data = request.json
         if data["files"] == [] or data["sources"] == []:
             response = jsonify({"paths":["test.png"]})
+        elif data.get("overlay", False):
+            # Sources of all files are overlaid in a single graph.
+            handlers = [get_handler(file) for file in data["files"]]
+            handlers[0].add_option(data=options)
+            response = jsonify({"paths":[
+                handlers[0].make_overlay(data["sources"], cols, handlers[1:])
+                ]})
         else:
-            files_created = []
+            futures = []
 
             for file in data["files"]:
                 local_handler = get_handler(file)
                 local_handler.add_option(data=options)
-                for source in data["sources"]:
-                    files_created.append(
-                        local_handler.make_graph(source,local_handler.filter_cols(source, cols))
-                        )
+                # Sources of a file are loaded together.
+                # Graphs of all files are rendered in parallel.
+                futures.extend(
+                    local_handler.submit_graphs(data["sources"], cols)
+                    )
+            files_created = [future.result() for future in futures]
             response = jsonify({"paths":files_created})
         response.headers.add('Access-Control-Allow-Origin', "*")
     return response
 
+@app.route("/"+conf.API_DATA, methods=["POST", "OPTIONS"])
+def graph_data():
+    if request.method == "OPTIONS":
+        response = options_response()
+    else:
+        options = CONFIG.config.copy()
+        cols = options.pop("cols", [])
+        data = request.json
+        # Series per file and source with maps to plot them in browser.
+        series = {file: get_handler(file).get_series(data["sources"], cols)
+                  for file in data["files"] if file in DB.get_files()}
+        response = jsonify({"series": series,
+                            **{key: options.get(key, {}) for key
+                               in ("color_map", "min_map", "max_map")}})
+        response.headers.add('Access-Control-Allow-Origin', "*")
+    return response
+
+@app.get("/"+conf.API_CACHE)
+def cache_stats():
+    # Check render cache counters.
+    return jsonify(CACHE.stats())
+
+@app.get("/"+conf.API_METRICS)
+def show_metrics():
+    # Check timings and counts of pipeline stages.
+    response = make_response(metrics.prometheus())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return response
+
 @app.route("/"+conf.API_LIST_FILES)
 def list_files():
     return ';\n'.join(DB.get_files())
 
 @app.get("/"+conf.API_IMGS)
 def list_imgs():
-    return DB.get_imgs
+    # Listed from the images manifest.
+    return jsonify(DB.get_imgs())
 
 @app.route("/"+conf.API_IMGS+"<filename>")
 def get_img(filename: str):
     filename = filename.split("/")[-1]
     if filename.split('.')[-1] not in _VALID_TYPES_:
         return conf._ERROR_IMG_
-    return send_from_directory("../", conf.__IMG_DIR__+filename, mimetype='image/png')
+    # Full resolution images may still be saving after their preview.
+    # Previews are served at once.
+    if filename == os_ops.full_name(filename):
+        wait_full(filename)
+    # Least recently accessed images are removed first over size limit.
+    os_ops.touch_img(filename)
+    image_type = filename.split('.')[-1]
+    return send_from_directory("../", conf.__IMG_DIR__+filename,
+                               mimetype='image/'+('jpeg' if image_type == 'jpg'
+                                                  else image_type))
 
 with app.app_context():
     _UPLOAD_PATH_ = conf.API_URL+conf.API_UPLOAD
@@ -179,4 +306,4 @@ def options_response():
     return response
 
 if __name__ == "__main__":
-    app.run(debug=False, port=conf.API_PORT)
+    app.run(debug=False, port=conf.API_PORT, threaded=True)
@@ -0,0 +1,288 @@
+import io
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from typing import Callable
+from src import conf, block_codec, DASGIP_loader, graph_maker, os_ops
+
+logger = conf.logging.getLogger(__name__)
+
+################################################################################
+# Benchmarks for the loading and graphing pipeline on synthetic DASGIP data.   #
+# Run from the main folder with: python -m src.benchmark                       #
+# Images rendered by benchmarks are removed once measured.                     #
+################################################################################
+
+def make_content(vessels: int = 1, rows: int = 20_160, channels: int = 40,
+                 gaps: float = .2, seed: int = 0) -> str:
+    '''
+       Build synthetic DASGIP csv content.
+
+       Defaults to a 14 days run with 1 minute logging and 40 PV channels.
+    '''
+
+    rng = np.random.default_rng(seed)
+    stamps = pd.date_range('2023-06-01', periods=rows, freq='min'
+                           ).strftime('%Y-%m-%d %H:%M:%S')
+    blocks = []
+    for v in range(1, vessels+1):
+        headers = [f'"Unit{v}.InoculationTime{v} []"'] + \
+                  [f'"Unit{v}.Ch{c}{v}.PV [u]"' for c in range(channels)]
+        values = rng.uniform(0, 100, (rows, channels)).round(3).astype(str)
+        values[rng.random((rows, channels)) < gaps] = ''
+        # Leading lines without time before inoculation.
+        inoculation = stamps.to_numpy(dtype=object, copy=True)
+        inoculation[:5] = ''
+        lines = [';'.join(line) for line in
+                 np.column_stack([inoculation, values]).tolist()]
+        blocks.append(conf._TOKEN_.format(v) + ';'.join(headers) + '\n' + \
+                      '\n'.join(lines) + conf._END_TOKEN_)
+    return ''.join(blocks)
+
+def _legacy_dataframe_loader(data_block: str,
+                             headers_map: dict) -> pd.DataFrame:
+    '''
+       Row by row loader kept as a reference for comparisons.
+    '''
+
+    df = pd.read_csv(io.StringIO(data_block), sep=';', usecols=headers_map.keys())
+    df.rename(columns=headers_map, inplace=True)
+    df.drop(range(df[df.columns[0]].first_valid_index()), inplace=True)
+    df.reset_index(drop=True, inplace=True)
+    df[df.columns[0]] = pd.to_datetime(df[df.columns[0]])
+    df[df.columns[0]] = df[df.columns[0]].apply(
+        lambda x: (x-df[df.columns[0]][0]).total_seconds()/3600)
+    for column in df.columns:
+        prev_value = None
+        for i in range(len(df)):
+            if pd.isna(df.at[i,column]):
+                df.at[i,column] = prev_value
+            else:
+                prev_value = df.at[i,column]
+    return df
+
+def timeit(func: Callable, *args, repeat: int = 3, **kwargs) -> tuple:
+    '''
+       Returns best wall time of ```repeat``` calls and last result.
+    '''
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def bench_dataframe_loader(rows: int = 20_160, channels: int = 40) -> None:
+    '''
+       Compare legacy and vectorized dataframe loaders on one vessel.
+    '''
+
+    block = DASGIP_loader.data_block_loader(
+        make_content(rows=rows, channels=channels))['Vessel 1']
+    header = DASGIP_loader.header_loader(block)
+    before, expected = timeit(_legacy_dataframe_loader, block, header, repeat=1)
+    after, result = timeit(DASGIP_loader.dataframe_loader, block, header)
+    pd.testing.assert_frame_equal(expected, result)
+    print(f'dataframe_loader ({rows} rows x {channels} channels): '
+          f'before {before:.3f}s, after {after:.3f}s, x{before/after:.0f}')
+
+def bench_dataframes_loader(vessels: int = 4, rows: int = 20_160,
+                            channels: int = 40) -> None:
+    '''
+       Compare loading vessels of a file one by one and in one pass, and
+       check the pass makes a single parser call.
+    '''
+
+    content = DASGIP_loader.data_block_loader(
+        make_content(vessels=vessels, rows=rows, channels=channels))
+    headers_maps = {source: DASGIP_loader.header_loader(content[source])
+                    for source in content}
+    before, expected = timeit(lambda: {
+        source: DASGIP_loader.dataframe_loader(content[source], headers_map)
+        for source, headers_map in headers_maps.items()})
+    read_csv, calls = pd.read_csv, []
+    def counted(*args, **kwargs):
+        calls.append(1)
+        return read_csv(*args, **kwargs)
+    pd.read_csv = counted
+    try:
+        after, result = timeit(DASGIP_loader.dataframes_loader,
+                               content, headers_maps, repeat=1)
+    finally:
+        pd.read_csv = read_csv
+    for source in expected:
+        pd.testing.assert_frame_equal(expected[source], result[source])
+    print(f'dataframes_loader ({vessels} vessels x {rows} rows x '
+          f'{channels} channels): one by one {before:.3f}s, '
+          f'one pass {after:.3f}s, {len(calls)} parser calls')
+    assert len(calls) == 1
+
+    # A token that is not a number in a block does not change the types
+    # of other blocks parsed in the same pass.
+    content = dict(content)
+    lines = content['Vessel 2'].split('\n')
+    time, _, values = lines[10].split(';', 2)
+    lines[10] = ';'.join((time, 'ERR', values))
+    content['Vessel 2'] = '\n'.join(lines)
+    result = DASGIP_loader.dataframes_loader(content, headers_maps)
+    for source in content:
+        pd.testing.assert_frame_equal(
+            DASGIP_loader.dataframe_loader(content[source],
+                                           headers_maps[source]),
+            result[source])
+
+def bench_decimation(rows: int = 1_000_000, channels: int = 3) -> None:
+    '''
+       Compare render time and peak traced memory with and without
+       decimation on one vessel.
+    '''
+
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.normal(size=(rows, channels)).cumsum(axis=0),
+                      columns=[f'Ch{c}' for c in range(channels)])
+    # One second logging.
+    df.insert(0, 'Time', np.arange(rows)/3600)
+    units = {column: 'u' for column in df.columns}
+    results = {}
+    for decimate in (False, True):
+        tracemalloc.start()
+        start = time.perf_counter()
+        filename = graph_maker.make_graph(df, units.copy(),
+                                          decimate=decimate, preview=False,
+                                          filename=f'benchmark_{decimate}_')
+        results[decimate] = (time.perf_counter() - start,
+                             tracemalloc.get_traced_memory()[1]/2**20)
+        tracemalloc.stop()
+        os_ops.remove_img(filename)
+    (before, before_mem), (after, after_mem) = results[False], results[True]
+    print(f'make_graph ({rows} rows x {channels} channels): '
+          f'before {before:.2f}s {before_mem:.0f}MiB, '
+          f'after {after:.2f}s {after_mem:.0f}MiB')
+
+def bench_preview(rows: int = 20_160, channels: int = 8) -> None:
+    '''
+       Compare time to first image of full resolution and preview renders.
+    '''
+
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.normal(size=(rows, channels)).cumsum(axis=0),
+                      columns=[f'Ch{c}' for c in range(channels)])
+    df.insert(0, 'Time', np.arange(rows)/60)
+    units = {column: 'u' for column in df.columns}
+    results = {}
+    for preview in (False, True):
+        results[preview], filename = timeit(
+            graph_maker.make_graph, df, units.copy(), preview=preview,
+            filename=f'benchmark_preview_{preview}_')
+        graph_maker.wait_full(filename)
+        for name in {filename, os_ops.full_name(filename)}:
+            os_ops.remove_img(name)
+    print(f'make_graph first image ({rows} rows x {channels} channels): '
+          f'full {results[False]:.2f}s, preview {results[True]:.2f}s')
+
+def bench_export(rows: int = 20_160, channels: int = 8) -> None:
+    '''
+       Compare saving with a tight bbox and the export and encode stages
+       on the same figure.
+    '''
+
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.normal(size=(rows, channels)).cumsum(axis=0),
+                      columns=[f'Ch{c}' for c in range(channels)])
+    df.insert(0, 'Time', np.arange(rows)/60)
+    units = {column: 'u' for column in df.columns}
+    W, H, *figsize = graph_maker.get_fig_size(channels)
+    with graph_maker.get_template(W, H, list(df.columns[1:])) as template:
+        template.fig.set_size_inches(figsize)
+        template.render(df['Time'].to_numpy(), df, units, {}, {},
+                        {column: 'black' for column in df.columns[1:]},
+                        'Benchmark', conf._DEFAULT_PLOT_PARAMS_, 23.,
+                        conf._DEFAULT_TITLE_PARAMS_, 20., np.arange(0, 400, 24))
+        before, _ = timeit(template.fig.savefig,
+                           conf.__IMG_DIR__ + 'benchmark_savefig.png',
+                           dpi=conf._DPI_, bbox_inches='tight', repeat=1)
+        draw, pixels = timeit(graph_maker.export, template, conf._DPI_,
+                              repeat=1)
+    encode, _ = timeit(graph_maker.encode, pixels, 'benchmark_export.png',
+                       repeat=1)
+    for filename in ('benchmark_savefig.png', 'benchmark_export.png'):
+        os_ops.remove_img(filename)
+    print(f'savefig ({channels} graphs at {conf._DPI_} DPI): '
+          f'before {before:.2f}s, after {draw+encode:.2f}s '
+          f'(draw {draw:.2f}s, encode {encode:.2f}s)')
+
+def bench_compression(rows: int = 20_160, channels: int = 40) -> None:
+    '''
+       Compare compression ratio, compression time and decode time of
+       stored block codecs on a long and a short block.
+    '''
+
+    for n in (rows, 60):
+        block = DASGIP_loader.data_block_loader(
+            make_content(rows=n, channels=channels))['Vessel 1']
+        headers = DASGIP_loader.header_loader(block)
+        parse, _ = timeit(DASGIP_loader.dataframe_loader, block, headers)
+        for codec in ('zlib', 'lzma'):
+            encode, data = timeit(block_codec.compress, block, codec, repeat=1)
+            decode, _ = timeit(block_codec.decompress, data, codec)
+            stream, _ = timeit(lambda: DASGIP_loader.dataframe_loader(
+                block_codec.open_block(data, codec), headers))
+            print(f'{codec} ({n} rows x {channels} channels): '
+                  f'ratio {len(block)/len(data):.1f}, '
+                  f'compress {encode:.3f}s, decompress {decode:.3f}s, '
+                  f'parse {parse:.3f}s, streamed parse {stream:.3f}s')
+
+def stress_rendering(renders: int = 16, threads: int = 8) -> None:
+    '''
+       Render graphs concurrently from a thread pool and check images
+       match serial rendering.
+    '''
+
+    rng = np.random.default_rng(0)
+    dfs = []
+    for i in range(renders):
+        df = pd.DataFrame(rng.normal(size=(2_000, 2)).cumsum(axis=0),
+                          columns=['DO', 'pH'])
+        df.insert(0, 'Time', np.arange(len(df))/60)
+        dfs.append(df)
+    units = {'Time': 'h', 'DO': '%', 'pH': 'pH'}
+    colors = ['red', 'blue', 'green', 'black']
+
+    def render(i: int, prefix: str) -> bytes:
+        filename = graph_maker.make_graph(
+            dfs[i], units.copy(), title=f'Vessel {i}',
+            color_map={'DO': colors[i % 4], 'pH': colors[(i+1) % 4]},
+            min_map={'DO': -i}, preview=False,
+            filename=f'stress_{prefix}_{i}_')
+        try:
+            with open(conf.__IMG_DIR__ + filename, 'rb') as f:
+                return f.read()
+        finally:
+            os_ops.remove_img(filename)
+
+    start = time.perf_counter()
+    serial = [render(i, 'serial') for i in range(renders)]
+    serial_time = time.perf_counter() - start
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        threaded = list(pool.map(render, range(renders),
+                                 ['threaded']*renders))
+    threaded_time = time.perf_counter() - start
+    mismatches = sum(a != b for a, b in zip(serial, threaded))
+    print(f'make_graph ({renders} renders, {threads} threads): '
+          f'serial {serial_time:.2f}s, threaded {threaded_time:.2f}s, '
+          f'{mismatches} mismatching images')
+    assert mismatches == 0
+
+
+if __name__ == '__main__':
+    bench_dataframe_loader()
+    bench_dataframes_loader()
+    bench_decimation()
+    bench_preview()
+    bench_export()
+    bench_compression()
+    stress_rendering()
@@ -0,0 +1,185 @@
+import io
+import lzma
+import time
+import zlib
+import hashlib
+import functools
+from typing import IO, Optional, Tuple, Union
+from src import conf, metrics
+
+logger = conf.logging.getLogger(__name__)
+
+################################################################################
+# Block codec compresses stored data blocks. zlib blocks use a preset          #
+# dictionary of DASGIP header vocabulary, so even short blocks compress well.  #
+# Changing the dictionary needs a new codec name: stored blocks keep theirs.   #
+################################################################################
+
+# Channels found in DASGIP headers, as in "Unit1.DO1.PV [%DO]".
+_CHANNELS_ = (('DO', '%DO'), ('pH', 'pH'), ('T', '°C'), ('N', 'rpm'),
+              ('F', 'sL/h'), ('XO2', '%'), ('XCO2', '%'), ('FO2', '%'),
+              ('FCO2', '%'), ('FAir', 'sL/h'), ('FN2', 'sL/h'),
+              ('VA', 'mL'), ('VB', 'mL'), ('FA', 'mL/h'), ('FB', 'mL/h'),
+              ('Level', '%'), ('CTR', 'mmol/h'), ('OUR', 'mmol/h'),
+              ('RQ', '-'), ('V', 'mL'))
+# Bytes of compressed data decompressed at a time when streaming.
+_READ_SIZE_ = 64*1024
+
+@functools.lru_cache(maxsize=1)
+def dictionary() -> bytes:
+    '''
+       Returns preset dictionary of DASGIP header vocabulary.
+
+       zlib finds matches closer to the end of the dictionary cheaper,
+       so common vessel numbers and row fragments come last.
+    '''
+
+    headers = ['"Unit1.InoculationTime1 []";"Unit1.Duration1 []"']
+    for suffix in ('SP', 'Out', 'PV'):
+        headers.append(';'.join(f'"Unit1.{channel}1.{suffix} [{unit}]"'
+                                for channel, unit in _CHANNELS_))
+    tokens = ''.join(conf._TOKEN_.format(i) for i in range(16, 0, -1))
+    rows = '\n2023-06-01 00:00:00;0.000;;;\n2023-06-01 00:01:00;100.0;7.00;37.0'
+    return (tokens + '\n'.join(headers) + rows).encode()
+
+def compress(block: str, codec: Optional[str] = conf._BLOCK_CODEC_,
+             level: int = conf._BLOCK_LEVEL_) -> Union[str, bytes]:
+    '''
+       Returns block compressed with codec, or block if codec is None.
+    '''
+
+    if codec is None:
+        return block
+    encoder = Encoder(codec, level, hashed=False)
+    encoder.update(block.encode())
+    return encoder.finish()[1]
+
+class Encoder():
+    def __init__(self, codec: Optional[str] = conf._BLOCK_CODEC_,
+                 level: int = conf._BLOCK_LEVEL_, hashed: bool = True):
+        '''
+           Compresses a block given in parts, as read from a stream, and
+           hashes it as ```os_ops.content_hash``` does, if hashed.
+
+           Records raw and compressed bytes of the block when finished.
+        '''
+
+        self.codec = codec
+        self.hash = hashlib.sha256() if hashed else None
+        self.size = 0
+        self.parts = []
+        self.seconds = 0.
+        if codec == 'zlib':
+            self.compressor = zlib.compressobj(level, zdict=dictionary())
+        elif codec == 'lzma':
+            self.compressor = lzma.LZMACompressor(preset=level)
+        elif codec is None:
+            self.compressor = None
+        else:
+            raise ValueError(f'Unknown block codec {codec}')
+
+    def update(self, data: bytes) -> None:
+        '''
+           Add part of the block.
+        '''
+
+        start = time.perf_counter()
+        if self.hash is not None: self.hash.update(data)
+        self.size += len(data)
+        self.parts.append(data if self.compressor is None
+                          else self.compressor.compress(data))
+        self.seconds += time.perf_counter() - start
+
+    def finish(self) -> Tuple[Optional[str], Union[str, bytes]]:
+        '''
+           Returns hash and stored block: compressed, or text if codec
+           is None.
+        '''
+
+        if self.compressor is None:
+            return (self.hash and self.hash.hexdigest(),
+                    b''.join(self.parts).decode('utf-8'))
+        start = time.perf_counter()
+        self.parts.append(self.compressor.flush())
+        compressed = b''.join(self.parts)
+        metrics.add('block_compress',
+                    self.seconds + time.perf_counter() - start,
+                    bytes=self.size, compressed_bytes=len(compressed))
+        return self.hash and self.hash.hexdigest(), compressed
+
+def _decompressor(codec: str):
+    '''
+       Returns incremental decompressor of codec.
+    '''
+
+    if codec == 'zlib':
+        return zlib.decompressobj(zdict=dictionary())
+    if codec == 'lzma':
+        return lzma.LZMADecompressor()
+    raise ValueError(f'Unknown block codec {codec}')
+
+class _Reader(io.RawIOBase):
+    '''
+       Binary stream decompressing a block as it is read.
+    '''
+
+    def __init__(self, data: bytes, codec: str) -> None:
+        self.data = memoryview(data)
+        self.position = 0
+        self.decompressor = _decompressor(codec)
+        self.pending = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.pending and self.position < len(self.data):
+            chunk = self.data[self.position:self.position + _READ_SIZE_]
+            self.position += len(chunk)
+            self.pending = self.decompressor.decompress(chunk)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+def open_block(data: Union[str, bytes],
+               codec: Optional[str]) -> IO[str]:
+    '''
+       Returns text stream of a stored block, decompressed as it is read.
+    '''
+
+    if codec is None:
+        return io.StringIO(data)
+    return io.TextIOWrapper(io.BufferedReader(_Reader(data, codec)),
+                            encoding='utf-8', newline='')
+
+def decompress(data: Union[str, bytes], codec: Optional[str]) -> str:
+    '''
+       Returns stored block decompressed.
+
+       Records decompressed bytes of the block.
+    '''
+
+    if codec is None:
+        return data
+    with metrics.stage('block_decompress',
+                       compressed_bytes=len(data)) as record:
+        if codec == 'zlib':
+            decompressor = zlib.decompressobj(zdict=dictionary())
+            block = decompressor.decompress(data) + decompressor.flush()
+        else:
+            block = _decompressor(codec).decompress(data)
+        record['bytes'] = len(block)
+    return block.decode('utf-8')
+
+def first_line(data: Union[str, bytes], codec: Optional[str]) -> str:
+    '''
+       Returns first line of a stored block decompressing only its start.
+    '''
+
+    with open_block(data, codec) as stream:
+        return stream.readline().rstrip('\n')
+
+
+if __name__ == '__main__':
+    print(f"{__file__} not supposed to run as main")
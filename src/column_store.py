@@ -0,0 +1,154 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+from typing import Optional
+from src import conf, metrics, os_ops, protocols
+
+logger = conf.logging.getLogger(__name__)
+
+_MANIFEST_ = "manifest.json"
+
+class ColumnStore():
+    def __init__(self, directory: str = conf.__COLUMNS_DIR__):
+        '''
+           Columnar binary store of loaded data blocks.
+
+           Each source of a file is kept as one .npy file per column and a
+           manifest. Handlers key files by block content hash, so equal
+           blocks uploaded under other names share their columns. Columns
+           are memory mapped when loaded, so only the selected columns are
+           read from disk.
+        '''
+
+        self.directory = directory
+        os_ops.check_folders(self.directory)
+
+    def _path(self, filename: str, source: Optional[str] = None) -> str:
+        '''
+           Returns directory of a file or of a source in a file.
+        '''
+
+        # Hash names to get safe directory names.
+        path = os.path.join(self.directory,
+                            hashlib.md5(filename.encode()).hexdigest())
+        if source is None:
+            return path
+        return os.path.join(path, hashlib.md5(source.encode()).hexdigest())
+
+    def _manifest(self, filename: str, source: str) -> dict:
+        '''
+           Returns manifest of a source or empty dictionary if not stored.
+        '''
+
+        try:
+            with open(os.path.join(self._path(filename, source),
+                                   _MANIFEST_), 'r') as f:
+                return json.load(f)
+        except:
+            return {}
+
+    def has(self, filename: str, source: str,
+            headers_map: protocols.DATA_TYPE) -> bool:
+        '''
+           Checks if all columns in headers mapping are stored.
+        '''
+
+        columns = self._manifest(filename, source).get('columns', {})
+        return headers_map != {} and all(raw in columns for raw in headers_map)
+
+    def put(self, filename: str, source: str, df: pd.DataFrame,
+            catalog: tuple) -> None:
+        '''
+           Store typed columns of a loaded source.
+
+           ```catalog``` entries give the raw header of each column.
+        '''
+
+        path = self._path(filename, source)
+        temp_path = path + '.tmp'
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+
+        columns = {}
+        for entry in catalog:
+            if entry.clean not in df: continue
+            try:
+                values = df[entry.clean].to_numpy(dtype=float)
+            except (TypeError, ValueError):
+                # Non numeric columns are loaded from content.
+                logger.info(f'Column {entry.raw} of {source} not stored')
+                continue
+            column_file = f'c{entry.position}.npy'
+            np.save(os.path.join(temp_path, column_file), values)
+            columns[entry.raw] = {'file': column_file, 'clean': entry.clean,
+                                  'position': entry.position,
+                                  'dtype': str(values.dtype)}
+
+        with open(os.path.join(temp_path, _MANIFEST_), 'w') as f:
+            json.dump({'filename': filename, 'source': source,
+                       'rows': len(df), 'columns': columns,
+                       'time': os_ops.get_time()}, f)
+        # Replace previous version of the source.
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(temp_path, path)
+        logger.info(f'Stored {len(columns)} columns of {filename} {source}')
+
+    def load(self, filename: str, source: str,
+             headers_map: protocols.DATA_TYPE) -> pd.DataFrame:
+        '''
+           Load DataFrame with columns in headers mapping renamed.
+
+           Columns keep the order they have in the data block.
+        '''
+
+        path = self._path(filename, source)
+        columns = self._manifest(filename, source)['columns']
+        selected = sorted((columns[raw]['position'], raw) for raw in headers_map)
+        return pd.DataFrame({
+            headers_map[raw]: np.load(os.path.join(path, columns[raw]['file']),
+                                      mmap_mode='r')
+            for _, raw in selected})
+
+    def remove(self, filename: str) -> None:
+        '''
+           Remove all sources of a file.
+        '''
+
+        shutil.rmtree(self._path(filename), ignore_errors=True)
+
+    def check_del(self, keys: Optional[set] = None) -> None:
+        '''
+           Checks for stored files overdue to delete.
+
+           If ```keys``` is given, as hashes of blocks still stored, files
+           not in it are removed: columns expire with the last upload of
+           their blocks, not with their own storage time. Otherwise files
+           stored longer than _TIME_KEEP_DATA_ are removed.
+        '''
+
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            for source in os.listdir(path):
+                try:
+                    with open(os.path.join(path, source, _MANIFEST_)) as f:
+                        manifest = json.load(f)
+                except:
+                    continue
+                # Remove files no longer stored or that expired.
+                if keys is not None:
+                    if manifest['filename'] in keys: continue
+                    metrics.count('evicted_columns')
+                elif os_ops.time_check(manifest['time'], conf._TIME_KEEP_DATA_):
+                    metrics.count('expired_columns')
+                else:
+                    continue
+                logger.info(f'removing columns {name}')
+                shutil.rmtree(path, ignore_errors=True)
+                break
+
+
+if __name__ == '__main__':
+    print(f"{__file__} not supposed to run as main")
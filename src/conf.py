@@ -1,3 +1,4 @@
+import os
 import logging
 import logging.handlers
 
@@ -21,8 +22,22 @@ _FILE_ = "./CSV/CTPCLI308268.Manager 584248e0.Control.csv"
 # Token for separating data blocks
 _TOKEN_ = '"[TrackData{}]"\n'
 _END_TOKEN_ = '\n\n'
+# Compressed file types accepted. Zip files may hold several csv files.
+_COMPRESSED_TYPES_ = ('.gz', '.zip', '.xz')
+# Bytes read at a time when streaming files.
+_CHUNK_SIZE_ = 1 << 20
 # Reads Inoculation and .PV headers from a data block.
 _HEADER_TAGS_ = ('Inoculation', '.PV')
+# Number of distinct header lines with memoized header catalogs.
+_HEADER_CACHE_SIZE_ = 256
+# Compact mode downcasts loaded columns to float32 and bool.
+_COMPACT_ = False
+# Max float32 error allowed as a fraction of the column range.
+_COMPACT_TOLERANCE_ = 1e-4
+# Tag of inoculation marker columns.
+_MARKER_TAG_ = 'Inoculation'
+# Timestamp format of the time column. None infers it from the first value.
+_DATE_FORMAT_ = None
 
     # API
 
@@ -33,18 +48,40 @@ API_UPLOAD = "upload"
 API_LIST_FILES = "file"
 API_IMGS = "img"
 API_GRAPH = "graph_maker"
+API_DATA = "graph_data"
+API_CACHE = "cache"
+API_METRICS = "metrics"
 
     # DATABASE
 
+# Database backend: 'sqlite' or 'json'. JSON databases migrate to sqlite.
+_DB_BACKEND_ = 'sqlite'
 # Database file
 __DB_DIR__ = "./DB/"
 __DB_FILE__ = __DB_DIR__+"prog_data.json"
+__SQLITE_FILE__ = __DB_DIR__+"prog_data.sqlite"
+# Graph configuration file and seconds to wait for more changes before writing
+__CONFIG_FILE__ = __DB_DIR__+"config.json"
+_CONFIG_DELAY_ = 1.
+# Columnar store directory
+__COLUMNS_DIR__ = __DB_DIR__+"columns/"
 # Images directory
 __IMG_DIR__ = "./IMG/"
+# Manifest of images: size, modification time and source
+__IMG_MANIFEST_FILE__ = __DB_DIR__+"images.json"
 
 _TIME_FORMAT_ = '%Y-%m-%d'
 _TIME_KEEP_DATA_ = 2 # days to keep data
 _TIME_KEEP_IMAG_ = 1 # days to keep images
+_IMG_CACHE_MAX_BYTES_ = 2*1024**3 # max size of cached images
+_CONTENT_CACHE_BYTES_ = 256*1024**2 # max size of data blocks kept in memory
+_DATA_MAX_BYTES_ = 4*1024**3 # max size of stored data, least used removed
+_IMG_MAX_BYTES_ = 4*1024**3 # max size of images, least used removed
+_SWEEP_INTERVAL_ = 10*60 # seconds between removals of expired and least used
+# Compression of stored data blocks: 'zlib' (with DASGIP dictionary), 'lzma'
+# or None. Blocks are kept compressed in the database and in memory.
+_BLOCK_CODEC_ = 'zlib'
+_BLOCK_LEVEL_ = 3 # zlib level or lzma preset, 0 to 9
 _ERROR_DB_ = "Database error: "
 _ERROR_IMG_ = "Image error: Invalid file type"
 
@@ -77,4 +114,32 @@ _GRAPH_KIND_ = 'line'
 # Subplot size.
 _GRID_ASPECT_ = (18,5)
 # DPI for saving images.
-_DPI_ = 300
\ No newline at end of file
+_DPI_ = 300
+# Save a fast preview at screen DPI first and the full image in background.
+_PREVIEW_ = True
+_PREVIEW_DPI_ = 72
+_PREVIEW_SUFFIX_ = '_preview'
+# Preview format: png, webp or jpeg. Quality for webp and jpeg (1-100).
+_PREVIEW_FORMAT_ = 'png'
+_PREVIEW_QUALITY_ = 85
+# PNG zlib level, 0 (fast) to 9 (small), and slower extra size optimization.
+_PNG_COMPRESS_LEVEL_ = 6
+_PNG_OPTIMIZE_ = False
+# Max seconds a request waits for a full resolution image being saved.
+_FULL_WAIT_ = 60
+# Threads saving full resolution images in background, at least 1.
+_SAVE_WORKERS_ = os.cpu_count() or 1
+# Decimate lines to min and max points per bucket before plotting.
+_DECIMATE_ = True
+# Buckets per pixel column of the saved image.
+_DECIMATE_BUCKETS_ = 1
+# Buckets of time series sent for plotting in the browser.
+_DATA_BUCKETS_ = 2000
+# Title and line colors of graphs overlaying several sources.
+_OVERLAY_TITLE_ = 'Overlay'
+_OVERLAY_COLORS_ = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd',
+                    '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf']
+# Processes rendering graphs in parallel. 1 renders in the request thread.
+_RENDER_WORKERS_ = os.cpu_count() or 1
+# Max number of figure templates kept for reuse.
+_MAX_TEMPLATES_ = 16
\ No newline at end of file
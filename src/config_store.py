@@ -0,0 +1,91 @@
+import os
+import json
+import atexit
+import threading
+from typing import Optional
+from src import conf, protocols
+
+logger = conf.logging.getLogger(__name__)
+
+class ConfigStore():
+    def __init__(self, filename: str = conf.__CONFIG_FILE__,
+                 delay: float = conf._CONFIG_DELAY_,
+                 initial: Optional[protocols.CONFIG_TYPE] = None):
+        '''
+           Graph configuration kept in its own small json file.
+
+           Writes are delayed by ```delay``` seconds, so bursts of changes
+           are written once, and are atomic (temporary file and rename).
+           Changes equal to the stored configuration are not written.
+           Pending writes are flushed at exit.
+
+           If the file does not exist, ```initial``` configuration is used.
+        '''
+
+        self.filename = filename
+        self.delay = delay
+        self.lock = threading.Lock()
+        self._timer = None
+        self.writes = 0
+        try:
+            with open(self.filename, 'r') as f:
+                self._config = json.load(f)
+            self._stored = self._config
+        except:
+            self._config = dict(initial or {})
+            self._stored = None
+            if self._config: self._schedule()
+        atexit.register(self.flush)
+
+    @property
+    def config(self) -> protocols.CONFIG_TYPE:
+        return self._config
+
+    @config.setter
+    def config(self, new_config: protocols.CONFIG_TYPE) -> None:
+        with self.lock:
+            if new_config == self._config:
+                return
+            self._config = new_config
+            self._schedule()
+
+    @config.deleter
+    def config(self) -> None:
+        self.config = {}
+
+    def _schedule(self) -> None:
+        '''
+           Restart timer of delayed write.
+        '''
+
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(self.delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self) -> None:
+        '''
+           Write configuration if changed since last write.
+        '''
+
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._config == self._stored:
+                return
+            try:
+                with open(self.filename + '.tmp', 'w') as f:
+                    json.dump(self._config, f)
+                os.replace(self.filename + '.tmp', self.filename)
+            except OSError as e:
+                logger.error(conf._ERROR_DB_ + f'unable to write config: {e}')
+                return
+            self._stored = self._config
+            self.writes += 1
+        logger.info('Saved configuration')
+
+
+if __name__ == '__main__':
+    print(f"{__file__} not supposed to run as main")
@@ -1,19 +1,35 @@
-import matplotlib
+import os
+import time
+import tempfile
+import threading
+import contextlib
+import matplotlib.style
 import numpy as np
 import pandas as pd
-from typing import Optional
-from src import conf, protocols, os_ops
+from PIL import Image
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from matplotlib.figure import Figure
+from matplotlib.text import Text
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from typing import Dict, Iterator, List, Optional, Tuple
+from src import conf, metrics, protocols, os_ops
 
-# Set non-GUI backend for matplotlib.
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-# Set style for matplotlib.
-plt.style.use(conf._PLOT_STYLE_)
+# Set style for matplotlib. Figures are drawn by a non-GUI canvas
+# without pyplot global state, so renders may run in several threads.
+matplotlib.style.use(conf._PLOT_STYLE_)
 
 logger = conf.logging.getLogger(__name__)
 
 _TEST_FILENAME_ = "dummy.png"
 _TIME_FORMAT_ = "%Y_%m_%d(%a)-%I_%M%p_"
+# Idle figure templates by grid shape and variables.
+_TEMPLATES_ = OrderedDict()
+_TEMPLATES_LOCK_ = threading.Lock()
+# Threads saving full resolution images and their pending futures.
+_SAVER_ = ThreadPoolExecutor(max_workers=max(conf._SAVE_WORKERS_, 1))
+_PENDING_ = {}
+_PENDING_LOCK_ = threading.Lock()
 
 def _build_color_map(units_mapping: protocols.DATA_TYPE,
                    color_map: Optional[protocols.DATA_TYPE] = None
@@ -44,6 +60,31 @@ def _build_color_map(units_mapping: protocols.DATA_TYPE,
     logger.info(f'{color_map = }')
     return color_map
 
+def min_max_decimate(x: np.ndarray, y: np.ndarray, buckets: int) -> tuple:
+    '''
+       Reduce series to the first, min, max and last points of each of
+       ```buckets``` equal slices, kept in order. Series with fewer than
+       four points per bucket are returned unchanged.
+
+       With a bucket per pixel column the drawn line is unchanged.
+    '''
+
+    n = len(y)
+    size = n // max(buckets, 1)
+    if size < 4:
+        return x, y
+    full = n - n % size
+    # Ignore NaN when searching for min and max of each slice.
+    slices = y[:full].reshape(-1, size)
+    low = np.where(np.isnan(slices), np.inf, slices).argmin(axis=1)
+    high = np.where(np.isnan(slices), -np.inf, slices).argmax(axis=1)
+    first = np.zeros_like(low)
+    index = np.sort(np.stack([first, low, high, first+size-1], axis=1),
+                    axis=1) + np.arange(0, full, size)[:, None]
+    # Keep the remaining points after the last full slice.
+    index = np.concatenate([index.ravel(), np.arange(full, n)])
+    return x[index], y[index]
+
 def get_fig_size(number_of_graphs: int) -> tuple:
     '''
        Get figure size ajusted to number of plots given a max height.
@@ -59,6 +100,354 @@ def get_fig_size(number_of_graphs: int) -> tuple:
     W, H = (1, number_of_graphs) if W == 0 else (W+(H!=0), conf._MAX_H_) 
     return (W, H, w*W, h*H)
 
+class FigureTemplate():
+    def __init__(self, W: int, H: int, plot_list: List[str],
+                 sources: Tuple[str, ...] = ()) -> None:
+        '''
+           Figure with a grid of W by H subplots and a line per variable.
+           If sources are given, each subplot has a line per source instead.
+
+           Templates are kept and reused by renders with the same grid
+           shape, variables and sources, which only swap line data and
+           restyle.
+        '''
+
+        self.fig = Figure()
+        FigureCanvasAgg(self.fig)
+        # Set layout
+        self.fig.subplots_adjust(top=0.95)
+        self.axes, self.lines, self.overlays = {}, {}, {}
+        for i, var in enumerate(plot_list, 1):
+            # Create subplot and an empty line for the variable.
+            self.axes[var] = self.fig.add_subplot(H, W, i)
+            if sources:
+                # Or an empty line for each source.
+                self.overlays[var] = {
+                    source: self.axes[var].plot([], [], label=source)[0]
+                    for source in sources}
+            else:
+                self.lines[var], = self.axes[var].plot([], [], label=var)
+
+    def render(self, x: np.ndarray, df: pd.DataFrame,
+               units_mapping: protocols.DATA_TYPE,
+               min_map: protocols.DATA_TYPE,
+               max_map: protocols.DATA_TYPE,
+               color_map: protocols.DATA_TYPE,
+               title: str,
+               plot_params: protocols.DATA_TYPE,
+               axis_fontsize: float,
+               title_params: protocols.DATA_TYPE,
+               legend_fontsize: float,
+               xticks: np.ndarray,
+               buckets: Optional[int] = None) -> None:
+        '''
+           Swap line data and restyle figure artists.
+
+           If buckets is given, lines are decimated to that many buckets.
+        '''
+
+        # Set title
+        self.fig.suptitle(title, **title_params)
+        for var, line in self.lines.items():
+            # Plot graphs with column 0 as abscissa and var as ordinate.
+            y = df[var].to_numpy(dtype=float)
+            if buckets: line.set_data(*min_max_decimate(x, y, buckets))
+            else: line.set_data(x, y)
+            line.set_color(color_map[var])
+            line.set_linewidth(plot_params.get('linewidth'))
+            self._style(var, units_mapping[df.columns[0]], units_mapping,
+                        min_map, max_map, plot_params, axis_fontsize,
+                        legend_fontsize, xticks)
+
+    def render_overlay(self, dfs: Dict[str, pd.DataFrame],
+                       units_mapping: protocols.DATA_TYPE,
+                       min_map: protocols.DATA_TYPE,
+                       max_map: protocols.DATA_TYPE,
+                       color_map: protocols.DATA_TYPE,
+                       title: str,
+                       plot_params: protocols.DATA_TYPE,
+                       axis_fontsize: float,
+                       title_params: protocols.DATA_TYPE,
+                       legend_fontsize: float,
+                       xticks: np.ndarray,
+                       buckets: Optional[int] = None) -> None:
+        '''
+           Swap line data of each source and restyle figure artists.
+
+           Sources missing a variable have an empty line.
+           If buckets is given, lines are decimated to that many buckets.
+        '''
+
+        # Set title
+        self.fig.suptitle(title, **title_params)
+        for var, lines in self.overlays.items():
+            for source, line in lines.items():
+                df = dfs[source]
+                # Plot graphs with column 0 as abscissa and var as ordinate.
+                x = df[df.columns[0]].to_numpy(dtype=float)
+                y = df[var].to_numpy(dtype=float) if var in df \
+                    else np.array([])
+                if buckets and len(y): line.set_data(
+                    *min_max_decimate(x, y, buckets))
+                else: line.set_data(x[:len(y)], y)
+                line.set_color(color_map[source])
+                line.set_linewidth(plot_params.get('linewidth'))
+            # Abscissa is the first key of units mapping.
+            self._style(var, next(iter(units_mapping.values())), units_mapping,
+                        min_map, max_map, plot_params, axis_fontsize,
+                        legend_fontsize, xticks)
+
+    def _style(self, var: str, time_unit: str,
+               units_mapping: protocols.DATA_TYPE,
+               min_map: protocols.DATA_TYPE,
+               max_map: protocols.DATA_TYPE,
+               plot_params: protocols.DATA_TYPE,
+               axis_fontsize: float,
+               legend_fontsize: float,
+               xticks: np.ndarray) -> None:
+        '''
+           Restyle subplot of variable and fit it to its lines.
+        '''
+
+        ax = self.axes[var]
+        ax.grid(plot_params.get('grid', False))
+        ax.tick_params(labelsize=plot_params.get('fontsize'))
+        # Fit limits to new data and ticks.
+        ax.set_autoscale_on(True)
+        ax.relim()
+        ax.autoscale_view()
+        ax.set_xticks(xticks)
+        # Set x and y labels, title, y limits and legend for the graph.
+        ax.set_ylabel(
+            units_mapping[var],
+            fontsize=axis_fontsize)
+        ax.set_xlabel(
+            f'Time ({time_unit})',
+            fontsize=axis_fontsize)
+        ax.set_ylim(bottom=min_map.get(var, None), top=max_map.get(var, None))
+        if plot_params.get('legend', True):
+            ax.legend(fontsize=legend_fontsize)
+
+def take_template(W: int, H: int, plot_list: List[str],
+                  sources: Tuple[str, ...] = ()) -> FigureTemplate:
+    '''
+       Take an idle figure template for grid shape, variables and overlaid
+       sources or build a new one. Templates are used by a single render
+       at a time and must be given back once saved.
+    '''
+
+    key = (W, H, tuple(plot_list), tuple(sources))
+    with _TEMPLATES_LOCK_:
+        idle = _TEMPLATES_.get(key, [])
+        template = idle and idle.pop()
+    if not template:
+        logger.info(f'Building figure template for {key}')
+        template = FigureTemplate(W, H, plot_list, sources)
+    template.key = key
+    return template
+
+def give_back(template: FigureTemplate) -> None:
+    '''
+       Give back template for reuse.
+
+       At most _MAX_TEMPLATES_ idle templates are kept.
+       Least recently used are dropped.
+       Idle templates keep no pixels: the canvas and its renderer at the
+       last DPI are replaced by an undrawn canvas, and texts drop the
+       renderer they last drew with.
+    '''
+
+    FigureCanvasAgg(template.fig)
+    for text in template.fig.findobj(Text):
+        text._renderer = None
+    with _TEMPLATES_LOCK_:
+        _TEMPLATES_.setdefault(template.key, []).append(template)
+        _TEMPLATES_.move_to_end(template.key)
+        while sum(map(len, _TEMPLATES_.values())) > conf._MAX_TEMPLATES_:
+            oldest = next(iter(_TEMPLATES_))
+            _TEMPLATES_[oldest].pop(0)
+            if _TEMPLATES_[oldest] == []: del _TEMPLATES_[oldest]
+
+@contextlib.contextmanager
+def get_template(W: int, H: int,
+                 plot_list: List[str]) -> Iterator[FigureTemplate]:
+    '''
+       Lends a figure template for grid shape and variables.
+    '''
+
+    template = take_template(W, H, plot_list)
+    try:
+        yield template
+    finally:
+        give_back(template)
+
+def export(template: FigureTemplate, dpi: float) -> np.ndarray:
+    '''
+       Draw template figure once at dpi and return its RGBA pixels cropped
+       to the tight box of its artists.
+
+       Unlike saving with a tight bbox, the figure is not drawn a second
+       time at the cropped size.
+    '''
+
+    fig = template.fig
+    with metrics.stage('draw') as record:
+        fig.set_dpi(dpi)
+        fig.canvas.draw()
+        # Tight box with savefig padding in pixels.
+        x0, y0, x1, y1 = dpi * fig.get_tightbbox(fig.canvas.get_renderer()
+            ).padded(matplotlib.rcParams['savefig.pad_inches']).extents
+        pixels = np.asarray(fig.canvas.buffer_rgba())
+        # Rows are counted from the top.
+        top, left = max(int(len(pixels) - y1), 0), max(int(x0), 0)
+        pixels = pixels[top:top+int(y1-y0), left:left+int(x1-x0)].copy()
+        record.update(bytes=pixels.nbytes, rows=pixels.shape[0],
+                      columns=pixels.shape[1])
+    return pixels
+
+def encode(pixels: np.ndarray, filename: str,
+           source: Optional[str] = None) -> str:
+    '''
+       Encode RGBA pixels as image in images directory with the format of
+       the filename extension and options from conf.
+
+       Image is written to a temporary file and renamed, so it is never
+       seen partially written, then added to the images manifest with
+       its source key.
+    '''
+
+    path = conf.__IMG_DIR__ + filename
+    image_format = os.path.splitext(filename)[1][1:].lower()
+    image_format = 'jpeg' if image_format == 'jpg' else image_format
+    options = {'png': {'compress_level': conf._PNG_COMPRESS_LEVEL_,
+                       'optimize': conf._PNG_OPTIMIZE_}
+              }.get(image_format, {'quality': conf._PREVIEW_QUALITY_})
+    with metrics.stage('encode', rows=pixels.shape[0],
+                       columns=pixels.shape[1]) as record:
+        image = Image.fromarray(pixels)
+        # Opaque images are encoded without alpha channel.
+        if image_format == 'jpeg' or pixels[..., 3].min() == 255:
+            image = image.convert('RGB')
+        # Temporary file is unique, as the same image may be saved by
+        # concurrent renders.
+        fd, part = tempfile.mkstemp(suffix='.part', dir=conf.__IMG_DIR__)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, format=image_format, **options)
+            os.replace(part, path)
+        except:
+            os.remove(part)
+            raise
+        record['bytes'] = os.path.getsize(path)
+    os_ops.save_img(filename, record['bytes'], source)
+    return filename
+
+def _save_full(template: FigureTemplate, filename: str,
+               source: Optional[str] = None) -> str:
+    '''
+       Save full resolution image. Template is given back once drawn.
+    '''
+
+    try:
+        try:
+            pixels = export(template, conf._DPI_)
+        finally:
+            give_back(template)
+        encode(pixels, filename, source)
+        logger.info(f'Full resolution image saved as {filename}')
+        return filename
+    finally:
+        with _PENDING_LOCK_:
+            _PENDING_.pop(filename, None)
+
+def wait_full(filename: str, timeout: float = conf._FULL_WAIT_) -> bool:
+    '''
+       Wait up to timeout seconds for full resolution image of filename
+       being saved. Returns if image is available.
+
+       Images saved by other processes are polled while their preview
+       exists.
+    '''
+
+    filename = os_ops.full_name(filename)
+    path = conf.__IMG_DIR__ + filename
+    with _PENDING_LOCK_:
+        future = _PENDING_.get(filename)
+    if future is not None:
+        wait([future], timeout)
+    deadline = time.monotonic() + timeout
+    while not os.path.isfile(path) and time.monotonic() < deadline and \
+          os.path.isfile(conf.__IMG_DIR__ + os_ops.preview_name(filename)):
+        time.sleep(.1)
+    return os.path.isfile(path)
+
+def _xticks(x_max: float, xticks_width: int) -> np.ndarray:
+    '''
+       Build xticks with specific width up to x_max.
+    '''
+
+    num_ticks = int(np.ceil(x_max/xticks_width)) if not np.isnan(x_max) else 0
+    return np.linspace(0,
+                       num_ticks*xticks_width,
+                       num=num_ticks+1,
+                       dtype=int)
+
+def _fit_plot_list(plot_list: List[str]) -> List[str]:
+    '''
+       Drop plots to fit in image.
+    '''
+
+    if len(plot_list) > conf._MAX_VARS_:
+        logger.info("Dropped plots to fit in image.")
+    return plot_list[:conf._MAX_VARS_]
+
+def _image_name(filename: Optional[str], title: str,
+                plot_list: List[str]) -> str:
+    '''
+       Build image filename from prefix or current datetime, title
+       and variables.
+    '''
+
+    # Add to filename the title and variables.
+    # If variables names make filename too long, use number of variables.
+    name_list = plot_list
+    if len('_'.join(plot_list))>conf._MAX_FILENAME_VAR_SIZE_:
+        name_list = [f'{len(plot_list)}_variables']
+    return (filename or os_ops.get_time()) + \
+            '_'.join([title] + name_list) + '.png'
+
+def _save(template: FigureTemplate, filename: str, preview: bool,
+          source: Optional[str] = None) -> str:
+    '''
+       Save rendered template as image and give it back.
+
+       If preview, a preview is saved and its name returned, while the full
+       resolution image is saved in background.
+    '''
+
+    try:
+        # Draw image or preview. Figure is kept for reuse.
+        pixels = export(template,
+                        conf._PREVIEW_DPI_ if preview else conf._DPI_)
+    except:
+        give_back(template)
+        raise
+    if not preview:
+        # Template is given back before encoding, so next render may draw.
+        give_back(template)
+        encode(pixels, filename, source)
+        logger.info(f'Graphs image saved as {filename}')
+        return filename
+    # Template is given back once full resolution image is drawn.
+    with _PENDING_LOCK_:
+        _PENDING_[filename] = _SAVER_.submit(_save_full, template, filename,
+                                             source)
+    # Preview is encoded while full resolution image is drawn.
+    encode(pixels, os_ops.preview_name(filename), source)
+    logger.info(f'Graphs preview saved as {os_ops.preview_name(filename)}')
+
+    return os_ops.preview_name(filename)
+
 def make_graph(df: pd.DataFrame,
                units_mapping: protocols.DATA_TYPE,
                min_map: protocols.DATA_TYPE = {},
@@ -70,86 +459,114 @@ def make_graph(df: pd.DataFrame,
                title_params: protocols.DATA_TYPE = conf._DEFAULT_TITLE_PARAMS_,
                legend_fontsize: float = 20.,
                xticks_width: int = conf._XTICKS_WIDTH_,
+               decimate: bool = conf._DECIMATE_,
+               preview: bool = conf._PREVIEW_,
                filename: Optional[str] = None) -> str:
     '''
        Makes graph from dataframe with each variable in a cell on a grid.
 
        Uses a units, color, min and max maps to set graphs limits, color and
        displayed units. Creates xticks from xticks width value.
+       Figures are reused from templates with the same grid and variables.
+       If decimate, lines are reduced to first, min, max and last points
+       per pixel column of the saved image.
+       If preview, a preview at screen DPI is saved and its name returned,
+       while the full resolution image is saved in background from the
+       same figure.
     '''
 
     # Build xticks with specific width.
-    num_ticks = int(np.ceil(df[df.columns[0]].max()/xticks_width))
-    xticks = np.linspace(0,
-                        num_ticks*xticks_width,
-                        num=num_ticks+1,
-                        dtype=np.int8)
+    x = df[df.columns[0]].to_numpy(dtype=float)
+    xticks = _xticks(np.nanmax(x) if len(x) else np.nan, xticks_width)
 
     # Build color_map if not provided.
     color_map = _build_color_map(units_mapping, color_map)
     # Guarantee that color_map does not have the abscissa as a key.
     color_map.pop(df.columns[0], None)
     # Get list of variables to plot.
-    plot_list = list(color_map.keys())
-
-    # Dropped plots to fit in image.
-    if len(plot_list) > conf._MAX_VARS_:
-        plot_list = plot_list[:conf._MAX_VARS_]
-        logger.info("Dropped plots to fit in image.")
+    plot_list = _fit_plot_list(list(color_map.keys()))
     # Get number of graphs and figure size.
     num_graphs = len(plot_list)
-    W, H, *plot_params['figsize'] = get_fig_size(num_graphs)
-    
-    fig = plt.figure()
-    # Set title
-    fig.suptitle(title, **title_params)
-    # Set layout
-    fig.tight_layout()
-    fig.subplots_adjust(top=0.95)
-
-
-    for var in plot_list:
-        i = plot_list.index(var)+1
-        # Create subplot
-        ax = plt.subplot(H*100+W*10+i)
-        # Show progress in terminal.
-        print(
-            'Building image [' + \
-            i*'=' + (num_graphs-i)*' ' + \
-            f']({i}/{num_graphs})', end='\r')
-        
-        # Plot graphs with column 0 as abscissa and var as ordinate.
-        df.plot(kind=conf._GRAPH_KIND_, x=df.columns[0], y=var,
-                ax=ax, **plot_params, color=color_map[var], xticks=xticks)
-        # Set x and y labels, title, y limits and legend for the graph.
-        ax.set_ylabel(
-            units_mapping[var],
-            fontsize=axis_fontsize)
-        ax.set_xlabel(
-            f'Time ({units_mapping[df.columns[0]]})',
-            fontsize=axis_fontsize)
-        ax.set_ylim(bottom=min_map.get(var, None), top=max_map.get(var, None))
-        ax.legend(fontsize=legend_fontsize)
-    
-    # Show progress in terminal.
-    print('Building graphs [' + \
-            num_graphs*'=' + \
-            f']({num_graphs}/{num_graphs})')
+    W, H, *figsize = get_fig_size(num_graphs)
+    # Image name prefix is kept as source key of the image.
+    source, filename = filename, _image_name(filename, title, plot_list)
 
-    # Add to filename the title and variables.
-    # If variables names make filename too long, use number of variables.
-    if len('_'.join(plot_list))>conf._MAX_FILENAME_VAR_SIZE_:
-        plot_list = [f'{len(plot_list)}_variables']
-    # Build filename from current datetime, title and variables.
-    filename = (filename or os_ops.get_time()) + \
-                '_'.join([title] + plot_list) + '.png'
-    # Save image in images directory and close plot to free resources.
-    plt.savefig(conf.__IMG_DIR__ + filename, dpi=conf._DPI_, bbox_inches='tight')
-    logger.info(f'Graphs image saved as {filename}')
-    plt.close()
+    template = take_template(W, H, plot_list)
+    try:
+        template.fig.set_size_inches(plot_params.get('figsize', figsize))
+        # Buckets per pixel column of each subplot.
+        buckets = decimate and int(conf._DECIMATE_BUCKETS_ * conf._DPI_ * \
+                                   template.fig.get_figwidth() / W)
+        # Record plot loop metrics.
+        with metrics.stage('plot', rows=len(x), columns=num_graphs):
+            template.render(x, df, units_mapping, min_map, max_map,
+                            color_map, title, plot_params, axis_fontsize,
+                            title_params, legend_fontsize, xticks, buckets)
+    except:
+        give_back(template)
+        raise
 
-    return filename
+    return _save(template, filename, preview, source)
+
+def make_overlay(dfs: Dict[str, pd.DataFrame],
+                 units_mapping: protocols.DATA_TYPE,
+                 min_map: protocols.DATA_TYPE = {},
+                 max_map: protocols.DATA_TYPE = {},
+                 color_map: Optional[protocols.DATA_TYPE] = None,
+                 title: str = conf._OVERLAY_TITLE_,
+                 plot_params = conf._DEFAULT_PLOT_PARAMS_,
+                 axis_fontsize: float = 23.,
+                 title_params: protocols.DATA_TYPE = conf._DEFAULT_TITLE_PARAMS_,
+                 legend_fontsize: float = 20.,
+                 xticks_width: int = conf._XTICKS_WIDTH_,
+                 decimate: bool = conf._DECIMATE_,
+                 preview: bool = conf._PREVIEW_,
+                 filename: Optional[str] = None) -> str:
+    '''
+       Makes graph overlaying dataframes with each variable in a cell on a
+       grid and a line per dataframe, labelled by its key.
+
+       Variables are the keys of units mapping after the abscissa. Color map
+       maps dataframe keys to colors. Missing colors are taken in order
+       from _OVERLAY_COLORS_. Other options are as in make_graph.
+    '''
+
+    # Build xticks with specific width from longest time.
+    x_max = max((np.nanmax(df[df.columns[0]].to_numpy(dtype=float))
+                 for df in dfs.values() if len(df)), default=np.nan)
+    xticks = _xticks(x_max, xticks_width)
+
+    # Build color map for dataframes.
+    sources = tuple(dfs.keys())
+    colors = iter(conf._OVERLAY_COLORS_*len(sources))
+    color_map = {source: (color_map or {}).get(source) or next(colors)
+                 for source in sources}
+    # Get list of variables to plot.
+    plot_list = _fit_plot_list(list(units_mapping.keys())[1:])
+    # Get number of graphs and figure size.
+    num_graphs = len(plot_list)
+    W, H, *figsize = get_fig_size(num_graphs)
+    # Image name prefix is kept as source key of the image.
+    source, filename = filename, _image_name(filename, title, plot_list)
+
+    template = take_template(W, H, plot_list, sources)
+    try:
+        template.fig.set_size_inches(plot_params.get('figsize', figsize))
+        # Buckets per pixel column of each subplot.
+        buckets = decimate and int(conf._DECIMATE_BUCKETS_ * conf._DPI_ * \
+                                   template.fig.get_figwidth() / W)
+        # Record plot loop metrics.
+        with metrics.stage('plot', columns=num_graphs*len(sources),
+                           rows=sum(map(len, dfs.values()))):
+            template.render_overlay(dfs, units_mapping, min_map, max_map,
+                                    color_map, title, plot_params,
+                                    axis_fontsize, title_params,
+                                    legend_fontsize, xticks, buckets)
+    except:
+        give_back(template)
+        raise
 
+    return _save(template, filename, preview, source)
 
 if __name__ == '__main__':
     from src import DASGIP_loader
@@ -1,15 +1,33 @@
-from typing import List, Optional, Union
-from src import conf, os_ops, protocols
+import functools
+import importlib
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional, Union
+import numpy as np
+from numpy import ndarray
+from pandas import DataFrame
+from src import conf, metrics, os_ops, protocols
 from src import DASGIP_loader, graph_maker
 
 logger = conf.logging.getLogger(__name__)
 
+# Process pool for rendering. Created on first use.
+_POOL_ = None
+_POOL_LOCK_ = threading.Lock()
+# Thread rendering again sources lost with a broken process pool.
+_FALLBACK_ = ThreadPoolExecutor(max_workers=1)
+
 class Handler():
     def __init__ (self,
                   content_source: Union[str, protocols.DATA_TYPE], *,
                   filename: Optional[str] = None,
                   loader: protocols.handler_loader = DASGIP_loader,
-                  graph_maker: protocols.handler_gmaker = graph_maker) -> None:
+                  graph_maker: protocols.handler_gmaker = graph_maker,
+                  store: Optional[protocols.handler_store] = None,
+                  cache: Optional[protocols.handler_cache] = None,
+                  compact: bool = conf._COMPACT_) -> None:
         '''
            Initializes handler with content from source and filename.
 
@@ -20,7 +38,15 @@ class Handler():
            else:
             - it is assumed to be a file path and used to get filename.
 
-           
+           If a store is given, loaded sources are kept in and read from it
+           using their content hash as key, so equal blocks of other files
+           share them.
+
+           If compact, loaded sources use compact dtypes and the memory
+           saved per source is kept in ```memory_saved```.
+
+           If a render cache is given, graphs already rendered from the same
+           content, headers and options are not rendered again.
         '''
         
         super(Handler, self).__init__()
@@ -28,8 +54,18 @@ class Handler():
         self.loader = loader
         # Keep graph maker module.
         self.graph_maker = graph_maker
+        # Keep columnar store.
+        self.store = store
+        # Keep render cache and content hashes per source.
+        self.cache = cache
+        self._hashes = {}
+        # Compact dtypes mode and bytes saved per source.
+        self.compact = compact
+        self.memory_saved = {}
         # Create graph options mapping
         self.options = {}
+        # Header catalogs per source.
+        self._catalogs = {}
 
         # Check content type for str or DATA_TYPE.
         if type(content_source) is str:
@@ -53,6 +89,18 @@ class Handler():
 
         return list(self.content.keys())
 
+    def catalog(self, source: str) -> tuple:
+        '''
+           Returns catalog of selected headers for source.
+
+           Catalog is computed once per source and kept by the handler.
+        '''
+
+        if source not in self._catalogs:
+            self._catalogs[source] = self.loader.header_catalog(self.content,
+                                                                source)
+        return self._catalogs[source]
+
     def get_variables(self, source: str) -> List[str]:
         '''
            Returns headers except first column for source or
@@ -61,8 +109,7 @@ class Handler():
 
         # If wrong source return empty
         if source not in self.sources: return ["Invalid source."]
-        return list(
-            self.loader.header_loader(self.content[source]).values())[1:]
+        return [entry.clean for entry in self.catalog(source)][1:]
    
     def filter_cols(self, source: str,
                     cols: List[str]=[]) -> protocols.DATA_TYPE:
@@ -76,7 +123,12 @@ class Handler():
         # If wrong source return empty
         if source not in self.sources: return {"Error": "Invalid source."}
         # Get header mapping
-        header_mapping = self.loader.header_loader(self.content[source])
+        header_mapping = {entry.raw: entry.clean
+                          for entry in self.catalog(source)}
+        # Check for minimum headers.
+        if len(header_mapping)<2:
+            logger.error(conf._ERROR_LOAD_HEADER_)
+            return {conf._ERROR_HEADER_: conf._ERROR_LOAD_HEADER_}
         # Uses first column as time
         time = next(iter(header_mapping.values()))
         # Return filtered mapping
@@ -149,27 +201,458 @@ class Handler():
     def remove_option(self, key: str) -> None:
         self.options.pop(key, None)
 
+    def load(self, headers_maps: Dict[str, protocols.DATA_TYPE]
+             ) -> Dict[str, DataFrame]:
+        '''
+           Load dataframes of sources with their header mappings.
+
+           Sources available in the store skip parsing.
+        '''
+
+        dfs = {}
+        if self.store is not None:
+            dfs = {source: self.store.load(self.content_hash(source), source,
+                                           headers_map)
+                   for source, headers_map in headers_maps.items()
+                   if self.store.has(self.content_hash(source), source,
+                                     headers_map)}
+        missing = {source: headers_map for source, headers_map
+                   in headers_maps.items() if source not in dfs}
+        # Loader deals with bad input.
+        if missing != {}:
+            dfs.update(self.loader.dataframes_loader(self.content, missing))
+        if self.compact:
+            for source, df in dfs.items():
+                dfs[source] = self.loader.compact_dataframe(df)
+                self.memory_saved[source] = int(
+                    df.memory_usage(deep=True).sum() - \
+                    dfs[source].memory_usage(deep=True).sum())
+                logger.info(f'Compact {source}: ' + \
+                            f'{self.memory_saved[source]} bytes saved')
+        return dfs
+
+    def store_sources(self) -> None:
+        '''
+           Load all sources with all selected headers and keep them in store.
+
+           Sources already in store, by content hash, are not loaded again.
+           Sources are loaded, stored and released one at a time, so memory
+           grows with the largest source, not with the file.
+        '''
+
+        if self.store is None: return
+        for source in self.sources:
+            headers_map = self.filter_cols(source)
+            if self.store.has(self.content_hash(source), source, headers_map):
+                continue
+            df = self.loader.dataframes_loader(self.content,
+                                               {source: headers_map}).get(source)
+            if df is None: continue
+            self.store.put(self.content_hash(source), source, df,
+                           self.catalog(source))
+            del df
+
     def make_graph(self, source: str,
-                   headers_map: protocols.DATA_TYPE = {}) -> str:
+                   headers_map: protocols.DATA_TYPE = {},
+                   filename: Optional[str] = None) -> str:
         '''
            Make graph from source with selected headers and options.
         '''
 
         # If wrong source return empty
         if source not in self.sources: return "Invalid source."
+        # Get dataframe.
+        df = self.load({source: headers_map})[source]
+        return self._make_graph(source, headers_map, df, filename)
+
+    def make_graphs(self, sources: List[str],
+                    cols: List[str] = []) -> List[str]:
+        '''
+           Make graphs from several sources with selected columns and options.
+
+           Sources are loaded together in a single pass of the loader.
+        '''
+
+        return [future.result() for future in self.submit_graphs(sources, cols)]
+
+    def submit_graphs(self, sources: List[str],
+                      cols: List[str] = []) -> List[Future]:
+        '''
+           Submit graphs from several sources with selected columns and
+           options. Returns futures of image filenames in sources order.
+
+           Sources in store are rendered by the process pool, reading their
+           columns from the store. Otherwise sources are loaded together and
+           rendered in this thread. Sources already being rendered with the
+           same cache key wait on that render.
+        '''
+
+        # Get header mapping for each valid source.
+        headers_maps = {source: self.filter_cols(source, cols)
+                        for source in sources if source in self.sources}
+        # Get cached images and filenames unique to each render.
+        futures, keys, filenames = {}, {}, {}
+        if self.cache is not None:
+            for source, headers_map in headers_maps.items():
+                keys[source] = self._cache_key(source, headers_map)
+                filenames[source] = \
+                    f'{self.filename or os_ops.get_time()}_{keys[source][:12]}_'
+                cached = self.cache.get(keys[source])
+                if cached is not None:
+                    futures[source] = _done(cached)
+                    continue
+                # Renders of the same key already running are waited on.
+                flight, claimed = self.cache.claim(keys[source])
+                if not claimed: futures[source] = flight
+        headers_maps = {source: headers_map for source, headers_map
+                        in headers_maps.items() if source not in futures}
+
+        try:
+            rendered = self._render_sources(headers_maps, filenames)
+        except Exception as e:
+            # Renders waiting on claimed keys fail too.
+            rendered = {source: _failed(e) for source in headers_maps}
+        # Add new images to cache once rendered and release their keys.
+        for source, future in rendered.items():
+            if source in keys:
+                future.add_done_callback(functools.partial(
+                    self.cache.finish, keys[source]))
+        futures.update(rendered)
+        return [futures.get(source) or _done("Invalid source.")
+                for source in sources]
+
+    def _render_sources(self, headers_maps: Dict[str, protocols.DATA_TYPE],
+                        filenames: Dict[str, str]) -> Dict[str, Future]:
+        '''
+           Render sources with headers maps. Returns futures of image
+           filenames by source.
+
+           Sources are rendered in this thread when the process pool is
+           disabled or broken.
+        '''
+
+        pool = get_pool()
+        if pool is not None and self.store is not None and \
+           all(self.store.has(self.content_hash(source), source, headers_map)
+               for source, headers_map in headers_maps.items()):
+            try:
+                rendered = {
+                    source: _unpack(pool.submit(
+                        _render, self.store, self.content_hash(source),
+                        source, headers_map, self._units(source, headers_map),
+                        {**self.options, 'title': source},
+                        filenames.get(source, self.filename), self.compact,
+                        self.loader.__name__, self.graph_maker.__name__),
+                        pool, functools.partial(self.make_graph, source,
+                                                headers_map,
+                                                filenames.get(source)))
+                    for source, headers_map in headers_maps.items()}
+            except BrokenProcessPool:
+                # Sources are rendered in this thread.
+                reset_pool(pool)
+            else:
+                # Images saved by the pool are added to the manifest here.
+                for source, future in rendered.items():
+                    future.add_done_callback(functools.partial(
+                        _add_image, filenames.get(source, self.filename)))
+                return rendered
+        # Get dataframes.
+        dfs = self.load(headers_maps)
+        return {source: _done(self._make_graph(source, headers_maps[source],
+                                               dfs[source],
+                                               filenames.get(source)))
+                for source in dfs}
+
+    def make_overlay(self, sources: List[str], cols: List[str] = [],
+                     others: List['Handler'] = []) -> str:
+        '''
+           Make one graph overlaying selected columns of sources on shared
+           axes, including the same sources of other handlers (files).
+
+           Sources of each file are loaded together in a single pass of
+           the loader. Lines are labelled by source, or by file and source
+           when overlaying several files.
+        '''
+
+        dfs, units_mapping, parts = {}, {}, []
+        for handler in [self, *others]:
+            # Get header mapping for each valid source.
+            headers_maps = {source: handler.filter_cols(source, cols)
+                            for source in sources if source in handler.sources}
+            headers_maps = {source: headers_map for source, headers_map
+                            in headers_maps.items()
+                            if conf._ERROR_HEADER_ not in headers_map}
+            # Get dataframes.
+            loaded = handler.load(headers_maps)
+            for source, headers_map in headers_maps.items():
+                label = f'{handler.filename} {source}' if others else source
+                dfs[label] = loaded[source]
+                units = handler._units(source, headers_map)
+                # Abscissa of the first source, then variables of all.
+                if units_mapping == {}: units_mapping.update(units)
+                units_mapping.update({var: unit for var, unit
+                                      in list(units.items())[1:]
+                                      if var not in units_mapping})
+                parts.append((label, handler.content_hash(source),
+                              list(headers_map.items())))
+        if dfs == {}: return "Invalid source."
+
+        # Colors of variables and titles of sources do not apply.
+        options = {key: value for key, value in self.options.items()
+                   if key not in ('color_map', 'title')}
+        filename = self.filename
+        if self.cache is not None:
+            key = self._render_key('overlay', parts, options)
+            filename = f'{self.filename or os_ops.get_time()}_{key[:12]}_'
+            cached = self.cache.get(key)
+            if cached is not None: return cached
+            # Renders of the same key already running are waited on.
+            flight, claimed = self.cache.claim(key)
+            if not claimed: return flight.result()
+        try:
+            rendered = _done(self.graph_maker.make_overlay(
+                dfs, units_mapping, **options, filename=filename))
+        except Exception as e:
+            rendered = _failed(e)
+        if self.cache is not None: self.cache.finish(key, rendered)
+        return rendered.result()
+
+    def get_series(self, sources: List[str], cols: List[str] = [],
+                   buckets: int = conf._DATA_BUCKETS_) -> protocols.CONFIG_TYPE:
+        '''
+           Returns time series of sources with selected columns and units,
+           for plotting by clients.
+
+           Each variable is decimated to first, min, max and last points of
+           ```buckets``` slices, keeping its own time column. Missing values
+           are None.
+        '''
+
+        # Get header mapping for each valid source.
+        headers_maps = {source: self.filter_cols(source, cols)
+                        for source in sources if source in self.sources}
+        series = {source: headers_map for source, headers_map
+                  in headers_maps.items() if conf._ERROR_HEADER_ in headers_map}
+        headers_maps = {source: headers_map for source, headers_map
+                        in headers_maps.items() if source not in series}
+        # Get dataframes.
+        for source, df in self.load(headers_maps).items():
+            x = df[df.columns[0]].to_numpy(dtype=float)
+            variables = {}
+            for var in df.columns[1:]:
+                time, values = self.graph_maker.min_max_decimate(
+                    x, df[var].to_numpy(dtype=float), buckets)
+                variables[var] = {'x': _to_list(time), 'y': _to_list(values)}
+            series[source] = {'units': self._units(source, headers_maps[source]),
+                              'variables': variables}
+        return series
+
+    def content_hash(self, source: str) -> str:
+        '''
+           Returns hash of source content. Kept by the handler.
+
+           Hashes known by the content, as for stored files, are used
+           without reading the source.
+        '''
+
+        if source not in self._hashes:
+            hashes = getattr(self.content, 'hashes', {})
+            self._hashes[source] = hashes[source] if source in hashes \
+                                   else os_ops.content_hash(self.content[source])
+        return self._hashes[source]
+
+    def _cache_key(self, source: str,
+                   headers_map: protocols.DATA_TYPE) -> str:
+        '''
+           Returns render cache key of source with selected headers.
+
+           Key depends on content, headers, options, style and resolution.
+        '''
+
+        return self._render_key(self.content_hash(source),
+                                list(headers_map.items()),
+                                {**self.options, 'title': source})
+
+    def _render_key(self, *parts) -> str:
+        '''
+           Returns render cache key of parts with style, resolution and
+           export settings.
+        '''
+
+        return self.cache.key(*parts,
+                              conf._PLOT_STYLE_, conf._DPI_, conf._DECIMATE_,
+                              conf._PREVIEW_, conf._PREVIEW_DPI_,
+                              conf._PREVIEW_FORMAT_,
+                              self.compact, self.graph_maker.__name__)
+
+    def _units(self, source: str,
+               headers_map: protocols.DATA_TYPE) -> protocols.DATA_TYPE:
+        '''
+           Get units mapping of headers from catalog.
+        '''
+
+        return {entry.clean: entry.unit for entry
+                in self.catalog(source) if entry.raw in headers_map}
+
+    def _make_graph(self, source: str, headers_map: protocols.DATA_TYPE,
+                    df: DataFrame, filename: Optional[str] = None) -> str:
+        '''
+           Make graph from source dataframe with options.
+        '''
+
         # Set title as source
         self.options.update({'title':source})
         # Get units mapping. Graph maker deals with bad header map.
-        units_mapping = self.loader.get_units(headers_map)
-        # Get dataframe. Loader deals with bad input.
-        df = self.loader.dataframe_loader(self.content[source], headers_map)
+        units_mapping = self._units(source, headers_map)
         # Make graph. Graph maker deals with bad input.
         return self.graph_maker.make_graph(df,
                                            units_mapping,
                                            **self.options,
-                                           filename=self.filename)
+                                           filename=filename or self.filename)
     
 
+def get_pool() -> Optional[ProcessPoolExecutor]:
+    '''
+       Returns process pool for rendering or None if disabled.
+
+       Pool is created on first use with _RENDER_WORKERS_ processes.
+       Workers are started by a fork server (spawned where not available),
+       not forked from this process, so locks held by its threads are not
+       copied into them.
+    '''
+
+    global _POOL_
+    if conf._RENDER_WORKERS_ <= 1:
+        return None
+    with _POOL_LOCK_:
+        if _POOL_ is None:
+            method = 'forkserver' if 'forkserver' in \
+                     multiprocessing.get_all_start_methods() else 'spawn'
+            context = multiprocessing.get_context(method)
+            # Workers are forked with loader and graph maker imported.
+            if method == 'forkserver':
+                context.set_forkserver_preload([__name__])
+            # Workers keep runs of stages to send back with each render.
+            _POOL_ = ProcessPoolExecutor(max_workers=conf._RENDER_WORKERS_,
+                                         mp_context=context,
+                                         initializer=metrics.keep_runs)
+        return _POOL_
+
+def reset_pool(pool: ProcessPoolExecutor) -> None:
+    '''
+       Shut down a broken process pool, as when a worker was killed.
+       Next render creates a new pool.
+    '''
+
+    global _POOL_
+    with _POOL_LOCK_:
+        if _POOL_ is not pool:
+            return
+        _POOL_ = None
+    logger.error('Render pool broken, starting a new one on next render')
+    pool.shutdown(wait=False)
+
+def _to_list(values: ndarray) -> list:
+    '''
+       Returns values as list with None for missing values.
+    '''
+
+    return np.where(np.isnan(values), None, values).tolist()
+
+def _add_image(source: Optional[str], future: Future) -> None:
+    '''
+       Add image rendered by the process pool to the images manifest,
+       with its full resolution image once saved.
+    '''
+
+    if future.exception() is None:
+        os_ops.save_img(future.result(), source=source)
+        os_ops.save_img(os_ops.full_name(future.result()), source=source)
+
+def _done(result: str) -> Future:
+    '''
+       Returns future already holding result.
+    '''
+
+    future = Future()
+    future.set_result(result)
+    return future
+
+def _failed(error: Exception) -> Future:
+    '''
+       Returns future already holding error.
+    '''
+
+    future = Future()
+    future.set_exception(error)
+    return future
+
+def _unpack(job: Future, pool: ProcessPoolExecutor,
+            fallback: Callable[[], str]) -> Future:
+    '''
+       Returns future of the image filename of a pool render. Stage
+       metrics sent back by the worker are aggregated once done.
+
+       If the pool breaks before the render is done, the pool is reset
+       and the source is rendered by ```fallback``` in a thread instead.
+    '''
+
+    future = Future()
+    job.add_done_callback(functools.partial(_unpacked, future, pool,
+                                            fallback))
+    return future
+
+def _unpacked(future: Future, pool: ProcessPoolExecutor,
+              fallback: Callable[[], str], job: Future) -> None:
+    '''
+       Set image filename of a pool render and aggregate its metrics.
+    '''
+
+    if isinstance(job.exception(), BrokenProcessPool):
+        reset_pool(pool)
+        _FALLBACK_.submit(fallback).add_done_callback(
+            functools.partial(_fell_back, future))
+        return
+    if job.exception() is not None:
+        future.set_exception(job.exception())
+        return
+    filename, drained = job.result()
+    metrics.merge(drained)
+    future.set_result(filename)
+
+def _fell_back(future: Future, job: Future) -> None:
+    '''
+       Set image filename of a source rendered again in a thread.
+    '''
+
+    if job.exception() is not None:
+        future.set_exception(job.exception())
+    else:
+        future.set_result(job.result())
+
+def _render(store: protocols.handler_store, key: str, source: str,
+            headers_map: protocols.DATA_TYPE,
+            units_mapping: protocols.DATA_TYPE,
+            options: protocols.CONFIG_TYPE,
+            filename: Optional[str], compact: bool,
+            loader_name: str, graph_maker_name: str) -> tuple:
+    '''
+       Render job run by the process pool.
+
+       Columns are memory mapped from the store, so no content is sent
+       to the worker. Returns image filename and runs of stages of the
+       worker since its last render, including full resolution images
+       saved since.
+    '''
+
+    df = store.load(key, source, headers_map)
+    if compact:
+        df = importlib.import_module(loader_name).compact_dataframe(df)
+    filename = importlib.import_module(graph_maker_name).make_graph(
+        df, units_mapping, **options, filename=filename)
+    return filename, metrics.drain()
+
+
 if __name__ == '__main__':
     handler = Handler(DASGIP_loader._mock_content_)
     srcs = handler.sources
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import atexit
+import threading
+from typing import Dict, List, Optional
+from src import conf
+
+logger = conf.logging.getLogger(__name__)
+
+class ImageManifest():
+    def __init__(self, directory: str = conf.__IMG_DIR__,
+                 filename: str = conf.__IMG_MANIFEST_FILE__):
+        '''
+           Manifest of images in images directory: size, modification time
+           and source key of each image.
+
+           Kept in memory and updated when images are saved or removed, so
+           listings and expiry do not scan the directory. Saved to
+           ```filename``` by ```save``` and at exit. Loaded on first read
+           and reconciled once with the directory, so images missed by a
+           stale file, as after a crash, are still counted and evicted.
+
+           Images saved by other processes are added without size and
+           checked by ```refresh``` until written.
+
+           Callables in ```listeners``` are called with filename and size
+           of each image added.
+        '''
+
+        self.directory = directory
+        self.filename = filename
+        self.lock = threading.RLock()
+        # Mapping of image filename to size, mtime and source.
+        self.entries = {}
+        # Images added before being written, by time added.
+        self.pending = {}
+        # Filenames removed before loading.
+        self._removed = set()
+        self._loaded = False
+        self._changed = False
+        self.listeners = []
+        atexit.register(self.save)
+
+    def _load(self) -> None:
+        '''
+           Load manifest file, or rebuild it if missing, and reconcile it
+           with images directory. Lock must be held.
+        '''
+
+        if self._loaded:
+            return
+        try:
+            with open(self.filename, 'r') as f:
+                entries = json.load(f)
+            logger.info('Loaded image manifest from file')
+        except:
+            entries = {}
+            logger.info('Rebuilding image manifest from images directory')
+        entries = self._reconcile(entries)
+        # Keep images saved or removed before loading.
+        for filename in self._removed:
+            entries.pop(filename, None)
+        entries.update(self.entries)
+        self.entries = entries
+        self._removed = set()
+        self._loaded = True
+
+    def _reconcile(self, entries: Dict[str, dict]) -> Dict[str, dict]:
+        '''
+           Returns entries of images in images directory. Images written
+           or removed since the manifest was saved, as before a crash, are
+           added or dropped. Temporary files left by encoders are removed.
+        '''
+
+        found = {}
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(path)
+                # Temporary files older than a render were left by a crash.
+                if filename.endswith('.part'):
+                    if time.time() - stat.st_mtime > conf._FULL_WAIT_:
+                        os.remove(path)
+                    continue
+            except OSError:
+                continue
+            if not os.path.isfile(path):
+                continue
+            found[filename] = entries.get(filename) or \
+                              {'size': stat.st_size, 'mtime': stat.st_mtime,
+                               'source': None}
+        if found != entries:
+            self._changed = True
+            logger.info(f'Reconciled image manifest: '
+                        f'{len(found.keys() - entries.keys())} added, '
+                        f'{len(entries.keys() - found.keys())} dropped')
+        return found
+
+    def add(self, filename: str, size: Optional[int] = None,
+            source: Optional[str] = None) -> None:
+        '''
+           Add saved image. Size and mtime are read from the file if size
+           is not given; images not written yet are kept pending.
+        '''
+
+        mtime = time.time()
+        if size is None:
+            try:
+                stat = os.stat(os.path.join(self.directory, filename))
+                size, mtime = stat.st_size, stat.st_mtime
+            except OSError:
+                with self.lock:
+                    self.pending[filename] = (mtime, source)
+                return
+        with self.lock:
+            self.entries[filename] = {'size': size, 'mtime': mtime,
+                                      'source': source}
+            self.pending.pop(filename, None)
+            self._removed.discard(filename)
+            self._changed = True
+        for listener in self.listeners:
+            listener(filename, size)
+
+    def remove(self, filename: str) -> None:
+        '''
+           Remove image from manifest.
+        '''
+
+        with self.lock:
+            self.entries.pop(filename, None)
+            self.pending.pop(filename, None)
+            if not self._loaded: self._removed.add(filename)
+            self._changed = True
+
+    def refresh(self, timeout: float = conf._FULL_WAIT_) -> None:
+        '''
+           Add pending images once written. Pending images not written
+           within timeout seconds are dropped.
+        '''
+
+        with self.lock:
+            pending = list(self.pending.items())
+        for filename, (added, source) in pending:
+            self.add(filename, source=source)
+            if time.time() - added > timeout:
+                with self.lock:
+                    self.pending.pop(filename, None)
+
+    def __contains__(self, filename: object) -> bool:
+        with self.lock:
+            self._load()
+            return filename in self.entries
+
+    def get(self, filename: str) -> Optional[dict]:
+        '''
+           Returns entry of image or None.
+        '''
+
+        with self.lock:
+            self._load()
+            return self.entries.get(filename)
+
+    def files(self) -> List[str]:
+        '''
+           Returns filenames of images.
+        '''
+
+        with self.lock:
+            self._load()
+            return list(self.entries)
+
+    def items(self) -> Dict[str, dict]:
+        '''
+           Returns copy of entries by filename.
+        '''
+
+        with self.lock:
+            self._load()
+            return dict(self.entries)
+
+    def save(self) -> None:
+        '''
+           Write manifest if loaded and changed since last write.
+           Pending images written since are added first.
+        '''
+
+        self.refresh()
+        with self.lock:
+            if not (self._loaded and self._changed):
+                return
+            try:
+                with open(self.filename + '.tmp', 'w') as f:
+                    json.dump(self.entries, f)
+                os.replace(self.filename + '.tmp', self.filename)
+            except OSError as e:
+                logger.error(conf._ERROR_DB_ +
+                             f'unable to write image manifest: {e}')
+                return
+            self._changed = False
+
+
+if __name__ == '__main__':
+    print(f"{__file__} not supposed to run as main")
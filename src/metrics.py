@@ -0,0 +1,193 @@
+import sys
+import time
+import threading
+import contextlib
+from typing import Iterator
+from src import conf
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+logger = conf.logging.getLogger(__name__)
+
+# Aggregates by stage name.
+_STAGES_ = {}
+# Event counters by name, as evictions.
+_COUNTERS_ = {}
+_LOCK_ = threading.Lock()
+# Runs of stages not yet taken by ```drain```, kept by worker processes.
+_RUNS_ = None
+# Peak resident memory reported by worker processes.
+_WORKER_PEAK_ = 0
+# Counts a stage may record.
+_COUNTS_ = ('bytes', 'compressed_bytes', 'rows', 'columns')
+# Prometheus metrics by aggregate: name, type and help.
+_METRICS_ = {
+    'calls': ('dasgip_stage_calls_total', 'counter',
+              'Number of runs of the stage.'),
+    'seconds': ('dasgip_stage_seconds_total', 'counter',
+                'Wall time spent in the stage.'),
+    'seconds_max': ('dasgip_stage_seconds_max', 'gauge',
+                    'Longest wall time of a run of the stage.'),
+    'bytes': ('dasgip_stage_bytes_total', 'counter',
+              'Bytes processed by the stage.'),
+    'compressed_bytes': ('dasgip_stage_compressed_bytes_total', 'counter',
+                         'Compressed bytes processed by the stage.'),
+    'rows': ('dasgip_stage_rows_total', 'counter',
+             'Rows processed by the stage.'),
+    'columns': ('dasgip_stage_columns_total', 'counter',
+                'Columns processed by the stage.')
+}
+
+def peak_memory() -> int:
+    '''
+       Returns peak resident memory of the process in bytes or 0 if unknown.
+    '''
+
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == 'darwin' else peak*1024
+
+@contextlib.contextmanager
+def stage(name: str, **counts) -> Iterator[dict]:
+    '''
+       Time a stage of the pipeline and aggregate its counts.
+
+       Yields a record of bytes, compressed bytes, rows and columns the
+       stage may update.
+       Each run is logged as a structured record with the ```metrics```
+       attribute.
+    '''
+
+    record = dict.fromkeys(_COUNTS_, 0)
+    record.update(counts)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.update(add(name, time.perf_counter() - start, **record))
+
+def add(name: str, seconds: float, **counts) -> dict:
+    '''
+       Aggregate a run of a stage timed by the caller, as a stage spread
+       over several calls. Returns record of the run.
+    '''
+
+    record = dict.fromkeys(_COUNTS_, 0)
+    record.update(counts)
+    record['seconds'] = seconds
+    with _LOCK_:
+        _aggregate(name, record)
+        if _RUNS_ is not None: _RUNS_.append((name, record))
+    logger.info(f'stage={name} ' + \
+                ' '.join(f'{k}={v:.4f}' if isinstance(v, float)
+                         else f'{k}={v}' for k, v in record.items()),
+                extra={'metrics': {'stage': name, **record}})
+    return record
+
+def _aggregate(name: str, record: dict) -> None:
+    '''
+       Add run of a stage to its aggregates. Lock must be held.
+    '''
+
+    total = _STAGES_.setdefault(name, dict.fromkeys(_METRICS_, 0))
+    total['calls'] += 1
+    total['seconds'] += record['seconds']
+    total['seconds_max'] = max(total['seconds_max'], record['seconds'])
+    for key in _COUNTS_:
+        total[key] += record[key]
+
+def keep_runs() -> None:
+    '''
+       Keep runs of stages for ```drain```. Set in worker processes,
+       whose aggregates are not served.
+    '''
+
+    global _RUNS_
+    _RUNS_ = []
+
+def drain() -> tuple:
+    '''
+       Returns runs of stages kept since last call and peak resident
+       memory of the process, to be merged by the serving process.
+    '''
+
+    global _RUNS_
+    with _LOCK_:
+        runs = _RUNS_ or []
+        if _RUNS_ is not None: _RUNS_ = []
+    return runs, peak_memory()
+
+def merge(drained: tuple) -> None:
+    '''
+       Aggregate runs of stages drained from a worker process.
+    '''
+
+    global _WORKER_PEAK_
+    runs, peak = drained
+    with _LOCK_:
+        for name, record in runs:
+            _aggregate(name, record)
+        _WORKER_PEAK_ = max(_WORKER_PEAK_, peak)
+
+def count(name: str, value: int = 1) -> None:
+    '''
+       Add value to an event counter.
+    '''
+
+    with _LOCK_:
+        _COUNTERS_[name] = _COUNTERS_.get(name, 0) + value
+
+def counters() -> dict:
+    '''
+       Returns copy of event counters.
+    '''
+
+    with _LOCK_:
+        return _COUNTERS_.copy()
+
+def snapshot() -> dict:
+    '''
+       Returns copy of aggregates by stage.
+    '''
+
+    with _LOCK_:
+        return {name: total.copy() for name, total in _STAGES_.items()}
+
+def prometheus() -> str:
+    '''
+       Returns aggregates by stage and event counters in Prometheus
+       text format.
+    '''
+
+    stages = snapshot()
+    lines = []
+    for key, (metric, kind, description) in _METRICS_.items():
+        lines.append(f'# HELP {metric} {description}')
+        lines.append(f'# TYPE {metric} {kind}')
+        lines.extend(f'{metric}{{stage="{name}"}} {total[key]}'
+                     for name, total in stages.items())
+    for name, value in counters().items():
+        metric = f'dasgip_{name}_total'
+        lines.append(f'# HELP {metric} Count of {name.replace("_", " ")}.')
+        lines.append(f'# TYPE {metric} counter')
+        lines.append(f'{metric} {value}')
+    # Peaks are process wide: stages of a process share them.
+    for metric, description, value in (
+            ('dasgip_process_peak_memory_bytes',
+             'Peak resident memory of the serving process.', peak_memory()),
+            ('dasgip_worker_peak_memory_bytes',
+             'Peak resident memory of render worker processes.', _WORKER_PEAK_)):
+        lines.append(f'# HELP {metric} {description}')
+        lines.append(f'# TYPE {metric} gauge')
+        lines.append(f'{metric} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    print(f"{__file__} not supposed to run as main")
@@ -1,7 +1,17 @@
 import os
+import gzip
+import time
+import hashlib
+import lzma
+import zipfile
 from datetime import datetime
-from typing import Union
-from src import conf
+from typing import IO, Iterator, Optional, Tuple, Union
+from src import conf, image_manifest, metrics
+
+logger = conf.logging.getLogger(__name__)
+
+# Last access time of images by filename, since start.
+_IMG_ACCESS_ = {}
 
 def std_name(filename: str) -> str:
     '''
@@ -9,7 +19,66 @@ def std_name(filename: str) -> str:
        with limited number of characters.
     '''
     
-    return os.path.splitext(os.path.basename(filename))[0][:42]
+    filename = os.path.basename(filename)
+    # Remove compression file type before file type.
+    if is_compressed(filename): filename = os.path.splitext(filename)[0]
+    return os.path.splitext(filename)[0][:42]
+
+def content_hash(block: str) -> str:
+    '''
+       Returns hash of a data block, used to share equal blocks.
+    '''
+
+    return hashlib.sha256(block.encode()).hexdigest()
+
+def is_compressed(filename: str) -> bool:
+    '''
+       Checks if filename is of a compressed file type.
+    '''
+
+    return filename.lower().endswith(conf._COMPRESSED_TYPES_)
+
+def open_archive(fileobj: IO[bytes],
+                 filename: str) -> Iterator[Tuple[str, IO[bytes]]]:
+    '''
+       Yields name and decompressing stream of each csv file in a
+       compressed file object. Nothing is decompressed in advance.
+
+       Zip files yield every csv file they hold.
+    '''
+
+    base, file_type = os.path.splitext(filename)
+    file_type = file_type.lower()
+    if file_type == '.gz':
+        yield base, gzip.GzipFile(fileobj=fileobj)
+    elif file_type == '.xz':
+        yield base, lzma.LZMAFile(fileobj)
+    elif file_type == '.zip':
+        with zipfile.ZipFile(fileobj) as archive:
+            for member in archive.infolist():
+                if not member.is_dir() and \
+                   member.filename.lower().endswith('.csv'):
+                    with archive.open(member) as stream:
+                        yield member.filename, stream
+
+def preview_name(filename: str) -> str:
+    '''
+       Get preview image name of full resolution image name.
+    '''
+
+    base, _ = os.path.splitext(full_name(filename))
+    return base + conf._PREVIEW_SUFFIX_ + '.' + conf._PREVIEW_FORMAT_
+
+def full_name(filename: str) -> str:
+    '''
+       Get full resolution image name of image or preview name.
+    '''
+
+    base, ext = os.path.splitext(filename)
+    if base.endswith(conf._PREVIEW_SUFFIX_):
+        # Full resolution images are png.
+        return base[:-len(conf._PREVIEW_SUFFIX_)] + '.png'
+    return base + ext
 
 def get_time() -> str:
      '''
@@ -23,35 +92,83 @@ def time_check(file_time: Union[str, datetime], max_time: str) -> bool:
        Check if file time is overdue
     '''
 
-    if type(file_time) == str: datetime.strptime(file_time, conf._TIME_FORMAT_)
+    if type(file_time) == str:
+        file_time = datetime.strptime(file_time, conf._TIME_FORMAT_)
     return (datetime.today() - file_time).days >= max_time
 
 def get_imgs() -> list:
     '''
-        Get file names from images directory
+        Get file names from images manifest
     '''
     
-    return [f for f in os.listdir(conf.__IMG_DIR__) if \
-            all([
-                os.path.isfile(os.path.join(conf.__IMG_DIR__, f)),
-                f.endswith(('.jpg', '.png', '.jpeg', '.gif'))
-            ])
-        ]
+    return [f for f in IMAGES.files()
+            if f.endswith(('.jpg', '.png', '.jpeg', '.gif', '.webp'))]
+
+def save_img(filename: str, size: Optional[int] = None,
+             source: Optional[str] = None) -> None:
+    '''
+        Add saved image to images manifest.
+    '''
+
+    IMAGES.add(filename, size, source)
+
+def remove_img(filename: str) -> None:
+    '''
+        Remove image from images directory and manifest.
+    '''
+
+    try:
+        os.remove(os.path.join(conf.__IMG_DIR__, filename))
+    except OSError:
+        pass
+    IMAGES.remove(filename)
+    _IMG_ACCESS_.pop(filename, None)
 
 def check_imag_del() -> None:
     '''
         Checks for images overdue to delete.
     '''
     
-    # Get files form IMG folder and check for timestamp expiration.
-    for filename in get_imgs():
-        # Get timestamp from file
-        file_time = datetime.fromtimestamp(
-            os.stat(os.path.join(conf.__IMG_DIR__, filename)).st_mtime
-            )
+    # Get images from manifest and check for timestamp expiration.
+    for filename, entry in IMAGES.items().items():
         # Remove files that expired.
-        if time_check(file_time, conf._TIME_KEEP_IMAG_):
-            os.remove(os.path.join(conf.__IMG_DIR__, filename))
+        if time_check(datetime.fromtimestamp(entry['mtime']),
+                      conf._TIME_KEEP_IMAG_):
+            remove_img(filename)
+            metrics.count('expired_images')
+            logger.info(f'Expired image {filename}')
+
+def touch_img(filename: str) -> None:
+    '''
+        Record access to an image.
+    '''
+
+    _IMG_ACCESS_[filename] = time.time()
+
+def check_imag_size(max_bytes: int = conf._IMG_MAX_BYTES_) -> None:
+    '''
+        Removes least recently used images while images exceed max_bytes.
+
+        Images not accessed since start are ordered by modification time.
+        Previews are removed with their full resolution image.
+    '''
+
+    # Size, last access and filenames of each full resolution image.
+    groups = {}
+    for filename, entry in IMAGES.items().items():
+        group = groups.setdefault(full_name(filename), [0, 0., []])
+        group[0] += entry['size']
+        group[1] = max(group[1], _IMG_ACCESS_.get(filename, entry['mtime']))
+        group[2].append(filename)
+    total = sum(group[0] for group in groups.values())
+    for size, _, filenames in sorted(groups.values(), key=lambda g: g[1]):
+        if total <= max_bytes: break
+        for filename in filenames:
+            remove_img(filename)
+        total -= size
+        metrics.count('evicted_images', len(filenames))
+        metrics.count('evicted_image_bytes', size)
+        logger.info(f'Evicted images {", ".join(filenames)}')
 
 def check_folders(folder: str):
     if not os.path.exists(folder):
@@ -59,6 +176,10 @@ def check_folders(folder: str):
 
 check_folders(conf.__IMG_DIR__)
 check_folders(conf.__DB_DIR__)
+check_folders(conf.__COLUMNS_DIR__)
+
+# Images in images directory, loaded on first use.
+IMAGES = image_manifest.ImageManifest()
 
 if __name__ == '__main__':
     print(f"{__file__} not supposed to run as main")
\ No newline at end of file
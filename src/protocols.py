@@ -1,23 +1,35 @@
-from typing import Any, Dict, Protocol, Optional
+from concurrent.futures import Future
+from typing import Any, Dict, Protocol, Optional, Tuple
 from pandas import DataFrame
+from numpy import ndarray
 
 DATA_TYPE = Dict[str,str]
 CONFIG_TYPE = Dict[str,Any]
 
 class handler_loader(Protocol):
     '''
-        Protocol module containing file_loader, header_loader
-        and dataframe_loader methods.
+        Protocol module containing file_loader, header_loader,
+        header_catalog, get_units, dataframe_loader, dataframes_loader
+        and compact_dataframe methods.
     '''
     
     def file_loader(filename: Optional[str] = None) -> DATA_TYPE:
         ...
     def header_loader(data_block: str) -> DATA_TYPE:
         ...
+    def header_catalog(content: DATA_TYPE, source: str) -> tuple:
+        ...
     def get_units(header_map: DATA_TYPE) -> DATA_TYPE:
         ...
     def dataframe_loader(data_block: str,
-                         headers_map: Optional[DATA_TYPE] = None) -> DataFrame:
+                         headers_map: Optional[DATA_TYPE] = None,
+                         size: Optional[int] = None) -> DataFrame:
+        ...
+    def dataframes_loader(content: DATA_TYPE,
+                          headers_maps: Dict[str, DATA_TYPE]
+                          ) -> Dict[str, DataFrame]:
+        ...
+    def compact_dataframe(df: DataFrame) -> DataFrame:
         ...
     
 class handler_gmaker(Protocol):
@@ -27,3 +39,38 @@ class handler_gmaker(Protocol):
     
     def make_graph(df: DataFrame, unit_map: DATA_TYPE, **kwargs) -> str:
         ...
+    
+    def make_overlay(dfs: Dict[str, DataFrame], unit_map: DATA_TYPE,
+                     **kwargs) -> str:
+        ...
+    
+    def min_max_decimate(x: ndarray, y: ndarray, buckets: int) -> tuple:
+        ...
+
+class handler_store(Protocol):
+    '''
+        Protocol object containing has, put and load methods.
+    '''
+
+    def has(filename: str, source: str, headers_map: DATA_TYPE) -> bool:
+        ...
+    def put(filename: str, source: str, df: DataFrame, catalog: tuple) -> None:
+        ...
+    def load(filename: str, source: str, headers_map: DATA_TYPE) -> DataFrame:
+        ...
+
+class handler_cache(Protocol):
+    '''
+        Protocol object containing key, get, put, claim and finish methods.
+    '''
+
+    def key(*parts) -> str:
+        ...
+    def get(key: str) -> Optional[str]:
+        ...
+    def put(key: str, filename: str) -> None:
+        ...
+    def claim(key: str) -> Tuple[Future, bool]:
+        ...
+    def finish(key: str, future: Future) -> None:
+        ...
@@ -0,0 +1,185 @@
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Optional, Tuple
+from src import conf, os_ops
+
+logger = conf.logging.getLogger(__name__)
+
+class RenderCache():
+    def __init__(self, max_bytes: int = conf._IMG_CACHE_MAX_BYTES_,
+                 max_days: int = conf._TIME_KEEP_IMAG_):
+        '''
+           Content addressed cache of rendered images.
+
+           Maps a key hashed from everything a render depends on to the
+           image filename in the images directory. Entries are evicted,
+           and their images removed, when older than ```max_days``` or
+           least recently used while images exceed ```max_bytes```.
+           Sizes count the image and its full resolution image, updated
+           when the full resolution image is saved after its preview.
+
+           A key is rendered once at a time: renders of a key being
+           rendered wait on the future of the first one.
+        '''
+
+        self.max_bytes = max_bytes
+        self.max_days = max_days
+        # Mapping of key to filename, size and creation time. LRU first.
+        self.entries = OrderedDict()
+        # Key of each cached image and its full resolution image.
+        self.keys = {}
+        # Futures of images being rendered by key.
+        self.rendering = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os_ops.IMAGES.listeners.append(self._added)
+
+    @staticmethod
+    def key(*parts) -> str:
+        '''
+           Returns hash of render parts.
+        '''
+
+        return hashlib.sha256(
+            json.dumps(parts, sort_keys=True, default=str).encode()
+            ).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        '''
+           Returns filename of image cached for key or None.
+        '''
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and \
+               (os_ops.time_check(entry[2], self.max_days) or
+                entry[0] not in os_ops.IMAGES):
+                self._evict(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: str, filename: str) -> None:
+        '''
+           Add image filename to cache and evict entries over limits.
+        '''
+
+        if filename not in os_ops.IMAGES:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (filename, _size(filename), datetime.today())
+            self.size += self.entries[key][1]
+            for name in {filename, os_ops.full_name(filename)}:
+                self.keys[name] = key
+            # Remove expired entries, then least recently used over size.
+            for old_key in [k for k, entry in self.entries.items()
+                            if os_ops.time_check(entry[2], self.max_days)]:
+                self._evict(old_key)
+            self._shrink()
+
+    def claim(self, key: str) -> Tuple[Future, bool]:
+        '''
+           Returns future of the image rendered for key and if the caller
+           claimed the render. The caller renders the image and gives its
+           future to ```finish```; other callers wait on the future.
+        '''
+
+        with self.lock:
+            if key in self.rendering:
+                return self.rendering[key], False
+            flight = Future()
+            # Image may have been rendered since it was looked up.
+            if key in self.entries:
+                flight.set_result(self.entries[key][0])
+                return flight, False
+            self.rendering[key] = flight
+            return flight, True
+
+    def finish(self, key: str, future: Future) -> None:
+        '''
+           Add image of a finished render claimed for key to cache and
+           pass its result to waiting renders.
+        '''
+
+        if future.exception() is None:
+            self.put(key, future.result())
+        with self.lock:
+            flight = self.rendering.pop(key, None)
+        if flight is None:
+            return
+        if future.exception() is None:
+            flight.set_result(future.result())
+        else:
+            flight.set_exception(future.exception())
+
+    def _added(self, filename: str, size: Optional[int]) -> None:
+        '''
+           Update size of the entry of an image added to the manifest,
+           as a full resolution image saved after its preview.
+        '''
+
+        with self.lock:
+            key = self.keys.get(filename)
+            if key not in self.entries:
+                return
+            name, old_size, created = self.entries[key]
+            self.entries[key] = (name, _size(name), created)
+            self.size += self.entries[key][1] - old_size
+            self._shrink()
+
+    def _shrink(self) -> None:
+        '''
+           Evict least recently used entries over size. Lock must be held.
+        '''
+
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            self._evict(next(iter(self.entries)))
+
+    def _evict(self, key: str) -> None:
+        '''
+           Remove entry and its image. Lock must be held.
+        '''
+
+        filename, size, _ = self.entries.pop(key)
+        self.size -= size
+        self.evictions += 1
+        # Remove image and its full resolution image if a preview.
+        for name in {filename, os_ops.full_name(filename)}:
+            if self.keys.get(name) == key: del self.keys[name]
+            os_ops.remove_img(name)
+        logger.info(f'Evicted cached image {filename}')
+
+    def stats(self) -> dict:
+        '''
+           Returns cache counters.
+        '''
+
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.size}
+
+def _size(filename: str) -> int:
+    '''
+       Returns size of image and its full resolution image if saved.
+    '''
+
+    return sum((os_ops.IMAGES.get(name) or {'size': 0})['size'] for name
+               in {filename, os_ops.full_name(filename)})
+
+
+if __name__ == '__main__':
+    print(f"{__file__} not supposed to run as main")
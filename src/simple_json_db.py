@@ -1,5 +1,7 @@
 import json
-from src import conf, os_ops, protocols
+import time
+from typing import Dict, Iterable, Tuple
+from src import conf, metrics, os_ops, protocols
 
 logger = conf.logging.getLogger(__name__)
 
@@ -9,17 +11,18 @@ class SimpleJSONDB():
            Simple JSON database.
            
            If file does not exist, create new database.
+           Expired data is removed by ```expire``` and least recently used
+           files over a size by ```evict```.
         '''
         
         self.filename = filename
+        # Last access time of files since start.
+        self.accessed = {}
         # Load data from file.
         try:
             with open(self.filename, 'r') as f:
                 self.data = json.load(f)
             logger.info('Loaded database from file')
-            # Remove expired data and images.
-            os_ops.check_imag_del()
-            self._check_data_del()
         # Or create new database.
         except:
             self.data = {
@@ -29,6 +32,14 @@ class SimpleJSONDB():
             }
             logger.info('Created new database')
 
+    def expire(self) -> None:
+        '''
+           Remove expired data and images.
+        '''
+
+        os_ops.check_imag_del()
+        self._check_data_del()
+
     def _check_data_del(self):
         '''
            Checks for data overdue to delete.
@@ -43,6 +54,34 @@ class SimpleJSONDB():
                 self.data['files'].pop(filename, None)
                 # Remove timestamp.
                 self.data['f_mng'].pop(filename, None)
+                self.accessed.pop(filename, None)
+                metrics.count('expired_files')
+
+    def evict(self, max_bytes: int = conf._DATA_MAX_BYTES_) -> None:
+        '''
+           Remove least recently used files while content exceeds
+           max_bytes. Files not accessed since start are ordered by upload.
+        '''
+
+        sizes = {filename: sum(map(len, content.values()))
+                 for filename, content in self.data['files'].items()}
+        size = sum(sizes.values())
+        for filename in sorted(sizes,
+                               key=lambda filename: self.accessed.get(filename, 0.)):
+            if size <= max_bytes: break
+            self.update_content(filename)
+            size -= sizes[filename]
+            metrics.count('evicted_files')
+            metrics.count('evicted_file_bytes', sizes[filename])
+            logger.info(f'Evicted {filename}, {sizes[filename]} bytes freed')
+
+    def get_hashes(self) -> set:
+        '''
+           Get content hashes of stored blocks.
+        '''
+
+        return {os_ops.content_hash(block) for content
+                in list(self.data['files'].values()) for block in content.values()}
                 
 
     @property
@@ -84,9 +123,31 @@ class SimpleJSONDB():
         if content == {}:
             self.data['files'].pop(filename, None)
             self.data['f_mng'].pop(filename, None)
+            self.accessed.pop(filename, None)
         else:
-            self.data['files'][filename] = content
+            # Decode lazy content blocks into a serializable dictionary.
+            self.data['files'][filename] = dict(content)
             self.data['f_mng'][filename] = os_ops.get_time()
+            self.accessed[filename] = time.time()
+
+    def store_parts(self, filename: str,
+                    parts: Iterable[Tuple[str, bytes, bool]]
+                    ) -> Dict[str, int]:
+        '''
+           Update content of a file from parts of its blocks, as yielded by
+           ```DASGIP_loader.iter_block_parts```.
+
+           Returns sizes of stored blocks by vessel.
+        '''
+
+        blocks, block = {}, []
+        for vessel, part, complete in parts:
+            block.append(part)
+            if complete:
+                blocks[vessel] = b''.join(block).decode('utf-8')
+                block = []
+        self.update_content(filename, blocks)
+        return {vessel: len(block.encode()) for vessel, block in blocks.items()}
     
     def get_content(self,
                     filename: str,
@@ -97,6 +158,8 @@ class SimpleJSONDB():
            If file does not exist, return empty dictionary.
         '''
 
+        if filename in self.data['files']:
+            self.accessed[filename] = time.time()
         return self.data['files'].get(filename, {conf._ERROR_HEADER_, conf._ERROR_FILE_})
     
     def commit(self):
@@ -104,9 +167,11 @@ class SimpleJSONDB():
            Save data changes to file
         '''
         
-        with open(self.filename, 'w') as f:
-            #write json to text file
-            json.dump(self.data, f)
+        with metrics.stage('db_commit') as record:
+            with open(self.filename, 'w') as f:
+                #write json to text file
+                json.dump(self.data, f)
+                record['bytes'] = f.tell()
 
 
 if __name__ == '__main__':
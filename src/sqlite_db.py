@@ -0,0 +1,523 @@
+import os
+import json
+import time as time_module
+import sqlite3
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import IO, Dict, Iterable, Iterator, Optional, Tuple, Union
+from src import block_codec, conf, metrics, os_ops, protocols
+
+logger = conf.logging.getLogger(__name__)
+
+_SCHEMA_ = '''
+    CREATE TABLE IF NOT EXISTS files (
+        filename TEXT PRIMARY KEY,
+        time TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS blobs (
+        hash TEXT PRIMARY KEY,
+        codec TEXT,
+        size INTEGER NOT NULL,
+        content BLOB NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS blocks (
+        filename TEXT NOT NULL REFERENCES files(filename) ON DELETE CASCADE,
+        vessel TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        hash TEXT NOT NULL REFERENCES blobs(hash),
+        PRIMARY KEY (filename, vessel)
+    );
+    CREATE INDEX IF NOT EXISTS blocks_hash ON blocks(hash);
+    CREATE TABLE IF NOT EXISTS config (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+'''
+
+class StoredContent(Mapping):
+    '''
+       Read only mapping of vessel names to data blocks of a stored file.
+
+       Blocks are read from the database when requested. Their content
+       hashes, in ```hashes```, are known without reading them.
+       ```open``` streams a block decompressing it as it is read.
+    '''
+
+    def __init__(self, db: 'SQLiteDB', filename: str,
+                 hashes: Dict[str, str]) -> None:
+        self.db = db
+        self.filename = filename
+        self.hashes = hashes
+        self.vessels = tuple(hashes)
+
+    def __getitem__(self, vessel: str) -> str:
+        block = self.db.get_block(self.hashes[vessel]) \
+                if vessel in self.hashes else None
+        if block is None:
+            raise KeyError(vessel)
+        return block
+
+    def header(self, vessel: str) -> str:
+        '''
+           Returns first line of a block decompressing only its start.
+        '''
+
+        return self.db.block_header(self.hashes[vessel])
+
+    def open(self, vessel: str) -> IO[str]:
+        '''
+           Returns text stream of a block.
+        '''
+
+        return self.db.open_block(self.hashes[vessel])
+
+    def size(self, vessel: str) -> int:
+        '''
+           Returns size in bytes of a block, uncompressed.
+        '''
+
+        return self.db.sizes.get(self.hashes[vessel], 0)
+
+    def __contains__(self, vessel: object) -> bool:
+        return vessel in self.vessels
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.vessels)
+
+    def __len__(self) -> int:
+        return len(self.vessels)
+
+class SQLiteDB():
+    def __init__(self, filename: str = conf.__SQLITE_FILE__,
+                 json_filename: str = conf.__DB_FILE__,
+                 cache_bytes: int = conf._CONTENT_CACHE_BYTES_,
+                 codec: Optional[str] = conf._BLOCK_CODEC_):
+        '''
+           SQLite database with the interface of SimpleJSONDB.
+
+           Files are rows with their vessel blocks as rows of their own.
+           Blocks reference blobs by content hash, so equal blocks of files
+           uploaded under other names are stored once. Blobs are compressed
+           with ```codec``` (see block_codec) and kept compressed in cache.
+           Each change is written in a short transaction of its own, on one
+           write connection. Reads run on a connection per thread, so in
+           write ahead log mode they do not wait for a change being written.
+
+           Only an index of files, upload times and block hashes is loaded at
+           start. Blocks are read on first use and kept in a cache of at
+           most ```cache_bytes```. Expired data is removed by ```expire```
+           and least recently used files over a size by ```evict```.
+
+           If a JSON database file exists, it is migrated once and renamed.
+        '''
+
+        self.filename = filename
+        self.codec = codec
+        # Write connection is shared by threads, one transaction at a time.
+        # State in memory is guarded by lock, taken after write_lock.
+        self.write_lock = threading.RLock()
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False,
+                                          isolation_level=None)
+        # Read connections by thread.
+        self._local = threading.local()
+        with self.write_lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('PRAGMA foreign_keys=ON')
+            self.connection.executescript(_SCHEMA_)
+        # Changes counted at last commit.
+        self._committed = self.connection.total_changes
+        # Index of filenames to upload time and block hashes by vessel,
+        # in upload order.
+        self.index = {}
+        # Last access time of files since start.
+        self.accessed = {}
+        # Uncompressed and stored size of blobs by content hash.
+        self.sizes = {}
+        self.stored = {}
+        # Codec and stored blocks by content hash. LRU first.
+        self.cache_bytes = cache_bytes
+        self._blocks = OrderedDict()
+        self._cached = 0
+        self._migrate(json_filename)
+        # Index and configuration as stored, with upload times kept.
+        self._config = {key: json.loads(value) for key, value
+                        in self.connection.execute('SELECT key, value FROM config')}
+        self._load_index()
+        logger.info('Loaded database index from file')
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        '''
+           Write in a transaction of its own, committed on exit and rolled
+           back on error. Nested transactions are savepoints of the outer.
+        '''
+
+        with self.write_lock:
+            self.connection.execute('SAVEPOINT write')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK TO write')
+                self.connection.execute('RELEASE write')
+                raise
+            self.connection.execute('RELEASE write')
+
+    def _reader(self) -> sqlite3.Connection:
+        '''
+           Returns read connection of the current thread.
+        '''
+
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.filename)
+            connection.execute('PRAGMA query_only=ON')
+            self._local.connection = connection
+        return connection
+
+    def _load_index(self) -> None:
+        '''
+           Load filenames, upload times and block hashes without content.
+        '''
+
+        with self.write_lock, self.lock:
+            hashes = {}
+            for filename, vessel, block_hash in self.connection.execute(
+                    'SELECT filename, vessel, hash FROM blocks '
+                    'ORDER BY filename, position'):
+                hashes.setdefault(filename, {})[vessel] = block_hash
+            self.index = {filename: (time, hashes.get(filename, {}))
+                          for filename, time in self.connection.execute(
+                              'SELECT filename, time FROM files ORDER BY rowid')}
+            self.sizes, self.stored = {}, {}
+            for block_hash, size, stored in self.connection.execute(
+                    'SELECT hash, size, length(content) FROM blobs'):
+                self.sizes[block_hash] = size
+                self.stored[block_hash] = stored
+
+    def expire(self) -> None:
+        '''
+           Remove expired data and images.
+        '''
+
+        os_ops.check_imag_del()
+        self._check_data_del()
+        self.commit()
+
+    def _migrate(self, json_filename: str) -> None:
+        '''
+           Copy files and configuration of a JSON database and rename it.
+        '''
+
+        if not os.path.isfile(json_filename):
+            return
+        try:
+            with open(json_filename, 'r') as f:
+                data = json.load(f)
+            with self._transaction(), self.lock:
+                for filename, content in data.get('files', {}).items():
+                    self.update_content(filename, content)
+                    # Keep upload time.
+                    self.connection.execute(
+                        'UPDATE files SET time = ? WHERE filename = ?',
+                        (data.get('f_mng', {}).get(filename, os_ops.get_time()),
+                         filename))
+                self.config = data.get('config', {})
+            os.replace(json_filename, json_filename + '.migrated')
+            logger.info(f'Migrated database from {json_filename}')
+        except:
+            logger.error(conf._ERROR_DB_ + f'unable to migrate {json_filename}')
+
+    def _check_data_del(self):
+        '''
+           Checks for data overdue to delete.
+        '''
+
+        with self.lock:
+            index = list(self.index.items())
+        # Get files from database and check for timestamp expiration.
+        for filename, (time, _) in index:
+            # Remove files that expired.
+            if os_ops.time_check(time, conf._TIME_KEEP_DATA_):
+                logger.info(f'removing {filename}')
+                self.update_content(filename)
+                metrics.count('expired_files')
+
+    def evict(self, max_bytes: int = conf._DATA_MAX_BYTES_) -> None:
+        '''
+           Remove least recently used files while stored blobs exceed
+           max_bytes. Files not accessed since start are ordered by upload.
+        '''
+
+        with self.lock:
+            filenames = sorted(self.index,
+                               key=lambda filename: self.accessed.get(filename, 0.))
+        for filename in filenames:
+            # Locks are taken per file, so requests run between removals.
+            with self.write_lock, self.lock:
+                size = sum(self.stored.values())
+                if size <= max_bytes: break
+                if filename not in self.index: continue
+                self.update_content(filename)
+                freed = size - sum(self.stored.values())
+            metrics.count('evicted_files')
+            metrics.count('evicted_file_bytes', freed)
+            logger.info(f'Evicted {filename}, {freed} bytes freed')
+
+    def get_hashes(self) -> set:
+        '''
+           Get content hashes of stored blocks.
+        '''
+
+        with self.lock:
+            return set(self.sizes)
+
+    @property
+    def config(self):
+        return self._config
+
+    @config.setter
+    def config(self, new_config: protocols.CONFIG_TYPE):
+        with self._transaction(), self.lock:
+            self.connection.execute('DELETE FROM config')
+            self.connection.executemany(
+                'INSERT INTO config (key, value) VALUES (?, ?)',
+                ((key, json.dumps(value)) for key, value in new_config.items()))
+            self._config = new_config
+
+    @config.deleter
+    def config(self):
+        self.config = {}
+
+    def get_imgs(self, *args, **kwargs) -> list:
+        '''
+           Get file names from images directory
+        '''
+
+        return os_ops.get_imgs()
+
+    def get_files(self, *args, **kwargs) -> list:
+        '''
+           Get list of available files to read from
+        '''
+
+        with self.lock:
+            return list(self.index.keys())
+
+    def update_content(self,
+                       filename: str,
+                       content: protocols.DATA_TYPE = {},
+                       *args, **kwargs) -> None:
+        '''
+           Update content from a file to database.
+
+           Blocks already stored, by content hash, are only referenced.
+           If content is empty, remove file from database.
+        '''
+
+        if content != {}:
+            # Lazy content blocks are decoded one at a time.
+            self.store_parts(filename, ((vessel, content[vessel].encode(), True)
+                                        for vessel in content))
+            return
+        with self._transaction():
+            with self.lock:
+                previous = set(self.index.get(filename, (None, {}))[1].values())
+            self.connection.execute(
+                'DELETE FROM files WHERE filename = ?', (filename,))
+            removed = self._remove_blobs(previous)
+        with self.lock:
+            self.index.pop(filename, None)
+            self.accessed.pop(filename, None)
+            self._forget_blobs(removed)
+
+    def store_parts(self, filename: str,
+                    parts: Iterable[Tuple[str, bytes, bool]]
+                    ) -> Dict[str, int]:
+        '''
+           Update content of a file from parts of its blocks, as yielded by
+           ```DASGIP_loader.iter_block_parts```.
+
+           Each block is hashed and compressed as its parts arrive and
+           stored once complete, so no block is kept whole in memory.
+           Blocks already stored, by content hash, are only referenced.
+
+           All blocks are written in one transaction, rolled back if
+           reading parts fails, so a failed upload keeps the previous
+           content of the file. The file is listed only once all its blocks
+           are stored, and not at all if it has none.
+
+           Returns sizes of stored blocks by vessel.
+        '''
+
+        time = os_ops.get_time()
+        hashes, sizes, added, encoder = {}, {}, {}, None
+        with self._transaction():
+            for vessel, part, complete in parts:
+                encoder = encoder or block_codec.Encoder(self.codec)
+                encoder.update(part)
+                if not complete: continue
+                block_hash, stored = encoder.finish()
+                if not hashes:
+                    # Keep position of known files.
+                    self.connection.execute(
+                        'INSERT INTO files (filename, time) VALUES (?, ?) '
+                        'ON CONFLICT(filename) DO UPDATE SET time = excluded.time',
+                        (filename, time))
+                    self.connection.execute(
+                        'DELETE FROM blocks WHERE filename = ?', (filename,))
+                if self._put_blob(block_hash, encoder.size, stored):
+                    added[block_hash] = (encoder.size, len(stored))
+                self.connection.execute(
+                    'INSERT INTO blocks (filename, vessel, position, hash) '
+                    'VALUES (?, ?, ?, ?)',
+                    (filename, vessel, len(hashes), block_hash))
+                hashes[vessel], sizes[vessel] = block_hash, encoder.size
+                encoder = None
+            if not hashes:
+                return sizes
+            with self.lock:
+                previous = set(self.index.get(filename, (None, {}))[1].values())
+            removed = self._remove_blobs(previous - set(hashes.values()))
+        # Publish stored file.
+        with self.lock:
+            for block_hash, (size, stored_size) in added.items():
+                self.sizes[block_hash] = size
+                self.stored[block_hash] = stored_size
+            self._forget_blobs(removed)
+            self.index[filename] = (time, hashes)
+            self.accessed[filename] = time_module.time()
+        logger.info(f'Stored {len(added)} new of {len(hashes)} blocks '
+                    f'of {filename}')
+        return sizes
+
+    def _put_blob(self, block_hash: str, size: int,
+                  stored: Union[str, bytes]) -> bool:
+        '''
+           Store block, as stored by its codec, if its hash is not stored.
+           Returns if stored.
+        '''
+
+        return self.connection.execute(
+            'INSERT OR IGNORE INTO blobs (hash, codec, size, content) '
+            'VALUES (?, ?, ?, ?)',
+            (block_hash, self.codec, size, stored)).rowcount == 1
+
+    def _remove_blobs(self, hashes: set) -> set:
+        '''
+           Remove blobs no longer referenced by any file.
+           Returns hashes of removed blobs.
+        '''
+
+        return {block_hash for block_hash in hashes
+                if self.connection.execute(
+                    'DELETE FROM blobs WHERE hash = ? AND NOT EXISTS '
+                    '(SELECT 1 FROM blocks WHERE hash = ?)',
+                    (block_hash, block_hash)).rowcount}
+
+    def _forget_blobs(self, hashes: set) -> None:
+        '''
+           Drop sizes and cached blocks of removed blobs.
+           Lock must be held.
+        '''
+
+        for block_hash in hashes:
+            self.sizes.pop(block_hash, None)
+            self.stored.pop(block_hash, None)
+            if block_hash in self._blocks:
+                self._cached -= len(self._blocks.pop(block_hash)[1])
+
+    def get_content(self,
+                    filename: str,
+                    *args, **kwargs) -> protocols.DATA_TYPE:
+        '''
+           Get content of a file from database.
+
+           If file does not exist, return error.
+        '''
+
+        with self.lock:
+            if filename not in self.index:
+                return {conf._ERROR_HEADER_: conf._ERROR_FILE_}
+            self.accessed[filename] = time_module.time()
+            return StoredContent(self, filename, self.index[filename][1])
+
+    def get_block(self, block_hash: str) -> Optional[str]:
+        '''
+           Get data block by content hash, decompressed.
+        '''
+
+        stored = self._stored_block(block_hash)
+        return stored and block_codec.decompress(stored[1], stored[0])
+
+    def open_block(self, block_hash: str) -> IO[str]:
+        '''
+           Get text stream of data block by content hash, decompressed
+           as it is read.
+        '''
+
+        stored = self._stored_block(block_hash)
+        if stored is None:
+            raise KeyError(block_hash)
+        return block_codec.open_block(stored[1], stored[0])
+
+    def block_header(self, block_hash: str) -> str:
+        '''
+           Get first line of data block by content hash.
+        '''
+
+        stored = self._stored_block(block_hash)
+        if stored is None:
+            raise KeyError(block_hash)
+        return block_codec.first_line(stored[1], stored[0])
+
+    def _stored_block(self, block_hash: str) -> Optional[tuple]:
+        '''
+           Get codec and stored data block from cache or database.
+
+           Least recently used blocks are dropped over the cache size.
+        '''
+
+        with self.lock:
+            if block_hash in self._blocks:
+                self._blocks.move_to_end(block_hash)
+                return self._blocks[block_hash]
+        # Read without lock, on the connection of this thread.
+        row = self._reader().execute(
+            'SELECT codec, content FROM blobs WHERE hash = ?',
+            (block_hash,)).fetchone()
+        if row is None:
+            return None
+        with self.lock:
+            if block_hash in self._blocks:
+                return self._blocks[block_hash]
+            self._blocks[block_hash] = row
+            self._cached += len(row[1])
+            while self._cached > self.cache_bytes and self._blocks:
+                self._cached -= len(self._blocks.popitem(last=False)[1][1])
+            return row
+
+    def commit(self):
+        '''
+           Changes are committed by their own transactions. Records rows
+           changed since last call.
+        '''
+
+        with metrics.stage('db_commit') as record, self.lock:
+            record['rows'] = self.connection.total_changes - self._committed
+            self._committed = self.connection.total_changes
+
+
+if __name__ == '__main__':
+    db = SQLiteDB()
+
+    if len(db.config): print("\nOpened existing database!")
+
+    print(f'\nStored configuration:\n{db.config}')
+
+    print(f'\nAvailable files:\n{db.get_files()}')
+
+    print(f'\nAvailable images:\n{db.get_imgs()}')
@@ -9,8 +9,10 @@
       // Function that requests the graphs and place them in website
       async function request_graph(options){
         document.getElementById("loader").style.display = "block";
-        await Promise.all(options["files"].map(async (file) => {
-          let file_option = {"files":[file], "sources":options["sources"]}
+        // Overlays of all files are requested together.
+        let requests = options["overlay"] ? [options["files"]] : options["files"].map((file) => [file]);
+        await Promise.all(requests.map(async (files) => {
+          let file_option = {"files":files, "sources":options["sources"], "overlay":options["overlay"]}
           let opt = {method: "POST", body: JSON.stringify(file_option),
                       headers: {"Content-Type": "application/json"}};
           // Call the API to generate the graphs and use list of file names to add graphs to website.
@@ -28,12 +30,17 @@
               img_frame.appendChild(title);
               // Break line
               img_frame.appendChild(document.createElement("br"));
+              // Link preview to full resolution image
+              let link = document.createElement("a");
+              link.href = document.getElementById("main").dataset.imgUrl+path.replace(/_preview\.\w+$/, ".png");
+              link.target = "_blank";
               // Create new image
               let img = document.createElement("img");
               img.src = document.getElementById("main").dataset.imgUrl+path;
               img.alt = path
               img.style = "width:1024px;";
-              img_frame.appendChild(img);
+              link.appendChild(img);
+              img_frame.appendChild(link);
             });
           });
         }));
@@ -77,6 +84,8 @@
           }
         });
         data["sources"] = sources;
+        // Overlay sources in a single graph.
+        data["overlay"] = document.getElementById("overlay").checked;
       }
       
       // Function to get selected files [DUMMY: IMPLEMENT THIS FUNCTION]